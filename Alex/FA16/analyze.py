@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import sys
 import os
 import subprocess
-import io
 import time
 # import serial
 import csv
 import statistics as st
 import itertools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SP17"))
+from datapoints import read_csv_columns, read_psd
+from aggregate import LossCounter
 
 parser = argparse.ArgumentParser()
 parser.add_argument("data",
@@ -38,22 +41,6 @@ if args.num != None and args.time != None:
     print("Do not provide both --num and --time")
     sys.exit(1)
 
-class Packet:
-    def __init__(self):
-        self.info = None
-        self.num = None
-        self.timestamp = None
-        self.length = None
-        self.ble_length = None
-        self.ble_access_addr = None
-        self.ble_header = None
-        self.ble_adv_addr = None
-        self.ble_payload = None
-        self.ble_crc = None
-        self.rssi = None
-        self.status = None
-        self.ble_seq_num = None
-
 class DataPoint:
     def __init(self):
         self.tag_id = None
@@ -72,20 +59,10 @@ def getIds(datapoints):
 
 def calculateStats(datapoints):
     ids = getIds(datapoints)
-    seq_num_received = dict([(tag, [dp.sequence_num for dp in datapoints if dp.tag_id == tag]) for tag in ids])
-    num_received = dict([(key, len(seq_num_received[key])) for key in seq_num_received])
-    num_expected = dict([(key, 1) for key in seq_num_received])
-    for key in seq_num_received:
-        lst = seq_num_received[key]
-        prev = lst[0]
-        for curr in lst[1:]:
-            if curr > prev:
-                num_expected[key] += curr - prev
-            elif curr < prev:
-                num_expected[key] += curr - prev + 256
-            else:
-                num_expected[key] += 1
-            prev = curr
+    counter = LossCounter(channels=[])
+    counter.update([dp.tag_id for dp in datapoints], [dp.sequence_num for dp in datapoints])
+    num_received = counter.received
+    num_expected = counter.expected
 
     avg_rssi = dict([(tag, st.mean([dp.rssi for dp in datapoints if dp.tag_id == tag])) for tag in ids])
     sd_rssi = dict([(tag, st.stdev([dp.rssi for dp in datapoints if dp.tag_id == tag])) for tag in ids])
@@ -106,49 +83,43 @@ datapoints = []
 ext = os.path.splitext(args.data)[1]
 if ext == ".psd":
     with open(args.data, "rb") as f:
-        while True:
-            b = f.read(1)
-            # Check for EOF
-            if not b:
-                break
-            # Skip nonstandard packets
-            if b != b"\x01":
-                f.seek(256, io.SEEK_CUR)
-                continue
-            
-            # Read out the data
-            p = Packet()
-            p.info = ord(b)
-            p.num = int.from_bytes(f.read(4), byteorder="little")
-            p.timestamp = int.from_bytes(f.read(8), byteorder="little")
-            p.length = int.from_bytes(f.read(2), byteorder="little")
-            p.ble_length = ord(f.read(1))
-            p.ble_access_addr = [b for b in reversed(f.read(4))]
-            p.ble_header = int.from_bytes(f.read(2), byteorder="little")
-            p.ble_adv_addr = [b for b in reversed(f.read(6))]
-            p.ble_payload = f.read(p.ble_length - 17)
-            p.ble_crc = int.from_bytes(f.read(3), byteorder="little")
-            p.rssi = ord(f.read(1))
-            p.status = ord(f.read(1))
-            
-            # Convert the data
-            # Timestamp conversion from TI document # SWRU187G, page 23
-            timeLo = p.timestamp & 0xFFFF
-            timeHi = p.timestamp >> 16
-            p.timestamp = (timeHi * 5000 + timeLo)//32000
-            p.ble_seq_num = p.ble_payload[2]
-            p.rssi = p.rssi - 94 # Conversion determined empirically
-            
-            # Build the data point
+        columns = read_psd(f)
+    for tag_id, sequence_num, timestamp, rssi in zip(
+            columns["tag_id"].tolist(), columns["sequence_num"].tolist(),
+            columns["timestamp"].tolist(), columns["rssi"].tolist()):
+        dp = DataPoint()
+        dp.tag_id = tag_id
+        dp.sequence_num = sequence_num
+        dp.timestamp = timestamp
+        dp.rssi = rssi
+        datapoints.append(dp)
+
+elif os.path.dirname(args.data) != "/dev" and args.num == None and args.time == None \
+        and not args.uart_dump:
+    # Parse a saved capture in bulk, then replay its scan interval markers
+    with open(args.data, "r") as f:
+        columns, markers, skipped = read_csv_columns(f)
+    if skipped:
+        print("Skipped {} malformed lines".format(skipped))
+    timestamps = columns["timestamp"]
+    if len(timestamps):
+        timestamps = timestamps - timestamps[0]
+    receive_intervals = [0] + [float(marker[1]) for marker in markers]
+    for segment, receive_interval in enumerate(receive_intervals):
+        if segment > 0:
+            calculateStats([i for i in datapoints if i.receive_interval == receive_intervals[segment-1]])
+            print("Receive interval: {}ms".format(receive_interval))
+        rows = columns["segment"] == segment
+        for tag_id, sequence_num, timestamp, rssi in zip(columns["tag_id"][rows].tolist(),
+                columns["sequence_num"][rows].tolist(), timestamps[rows].tolist(),
+                columns["rssi"][rows].tolist()):
             dp = DataPoint()
-            dp.tag_id = int(p.ble_adv_addr[-1])
-            dp.sequence_num = int(p.ble_seq_num)
-            dp.timestamp = int(p.timestamp)
-            dp.rssi = int(p.rssi)
+            dp.tag_id = tag_id
+            dp.sequence_num = sequence_num
+            dp.timestamp = timestamp
+            dp.rssi = rssi
+            dp.receive_interval = receive_interval
             datapoints.append(dp)
-            
-            # Skip to the next packet
-            f.seek(256 - p.length, io.SEEK_CUR)
 
 else:
     with open(args.data, "r") as f:
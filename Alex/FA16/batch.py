@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+''' Compute the FA16 result tables in one process.
+
+Replaces the count_*.sh scripts, which ran analyze.py once per file and
+table and scraped its output. Every capture is parsed once, files are
+analyzed in parallel, and each table is written as a CSV file:
+
+  baseline_order.csv     per baseline, whether each position was ordered right
+  baseline_sd.csv        RSSI standard deviation per baseline and position
+  baseline_loss.csv      packet loss per baseline and position
+  distances_loss.csv     packet loss per channel, position and distance
+  distances_sd.csv       RSSI standard deviation per channel, position and distance
+  distances_rssi.csv     mean RSSI per channel, position and distance
+  scan_intervals_loss.csv               packet loss per scan interval and position
+  scan_intervals_single_channel_loss.csv  packet loss per channel and scan interval
+                                          (and over the whole capture)
+
+Losses are fractions. A tag's position is its rank among the tag IDs
+detected in the capture, as in the tables the shell scripts produced:
+counted from 0 in the baseline and distance tables but from 1 in the
+scan interval table, as the scripts derived it from line numbers in
+analyze.py's output.
+'''
+
+import argparse
+import csv
+import glob
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SP17"))
+from datapoints import DataPoints, read_csv_columns
+from aggregate import expected_counts, group_stats
+from dataset import pool_map
+
+
+def tag_stats(datapoints):
+    ''' Loss and RSSI statistics of every tag, as analyze.py prints them. '''
+    ids = datapoints.get_ids()
+    stats = group_stats(datapoints, channels=[])
+    expected = expected_counts(datapoints)
+    rssi_avg = dict(zip(ids, stats.tag_mean.tolist()))
+    return {
+        "ids": ids,
+        "loss": dict(zip(ids, (1 - stats.tag_count / expected).tolist())),
+        "rssi_avg": rssi_avg,
+        "rssi_sd": dict(zip(ids, stats.tag_sd.tolist())),
+        "order": sorted(rssi_avg, key=rssi_avg.get, reverse=True),
+    }
+
+
+def analyze_file(path):
+    ''' Statistics of a whole capture and of each of its scan intervals.
+
+    Returns (overall, intervals), where intervals lists (scan interval,
+    statistics) for every run of packets after a scan interval marker.
+    '''
+    with open(path) as f:
+        columns, markers, _ = read_csv_columns(f)
+    segment = columns.pop("segment")
+    datapoints = DataPoints(**columns)
+    intervals = []
+    for i, marker in enumerate(markers, 1):
+        rows = segment == i
+        if rows.any():
+            intervals.append((float(marker[1]), tag_stats(datapoints.take(rows))))
+    return tag_stats(datapoints), intervals
+
+
+def analyze_files(paths, jobs=None):
+    ''' Analyze captures across a process pool, keyed by path. '''
+    return dict(zip(paths, pool_map(analyze_file, paths, jobs)))
+
+
+def __name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def __round(value):
+    return round(value, 4)
+
+
+def baseline_tables(results):
+    ''' Baseline captures are named after the tags' order, nearest first. '''
+    order, sd, loss = [], [], []
+    for path, (stats, _) in results.items():
+        name = __name(path)
+        detected = "".join(map(str, stats["order"]))
+        order.append([name] + [int(detected[i:i+1] == name[i]) for i in range(len(name))])
+        for position, tag in enumerate(name):
+            if int(tag) in stats["ids"]:
+                sd.append([name, position, __round(stats["rssi_sd"][int(tag)])])
+                loss.append([name, position, __round(stats["loss"][int(tag)])])
+    return {
+        "baseline_order": [["Order", "Nearest", "", "", "Farthest"]] + order,
+        "baseline_sd": [["Order", "Position", "SD"]] + sd,
+        "baseline_loss": [["Order", "Position", "Loss"]] + loss,
+    }
+
+
+def distance_tables(results):
+    ''' Distance captures are <distance>/<channel>.csv. '''
+    tables = dict((key, []) for key in ["loss", "rssi_sd", "rssi_avg"])
+    for path, (stats, _) in results.items():
+        distance = os.path.basename(os.path.dirname(path))
+        for position, tag in enumerate(stats["ids"]):
+            for key in tables:
+                tables[key].append([__name(path), position, distance, __round(stats[key][tag])])
+    header = ["Channel", "Position", "Distance"]
+    return {
+        "distances_loss": [header + ["Loss"]] + tables["loss"],
+        "distances_sd": [header + ["SD"]] + tables["rssi_sd"],
+        "distances_rssi": [header + ["RSSI"]] + tables["rssi_avg"],
+    }
+
+
+def scan_interval_tables(results):
+    ''' Scan interval captures are test_<interval>.csv. '''
+    rows = []
+    for path, (stats, _) in results.items():
+        # From 1, unlike the other tables, as count_scan_interval.sh numbered them
+        for position, tag in enumerate(stats["ids"], 1):
+            rows.append([__name(path)[5:], position, __round(stats["loss"][tag])])
+    return {"scan_intervals_loss": [["Scan Interval", "Position", "Loss"]] + rows}
+
+
+def single_channel_tables(results):
+    ''' Single channel captures are <channel>.csv, split by scan interval markers.
+
+    The whole capture is listed last with an empty scan interval.
+    '''
+    rows = []
+    for path, (stats, intervals) in results.items():
+        for interval, interval_stats in intervals + [("", stats)]:
+            for tag in interval_stats["ids"]:
+                rows.append([__name(path), interval, __round(interval_stats["loss"][tag])])
+    return {"scan_intervals_single_channel_loss": [["Channel", "Scan Interval", "Loss"]] + rows}
+
+
+# Each experiment: the captures it is made of and how to tabulate them
+EXPERIMENTS = {
+    "baseline": (["baselines/????.csv"], baseline_tables),
+    "distances": (["distances/*/??.csv"], distance_tables),
+    "scan_intervals": (["scan intervals/test_??.csv", "scan intervals/test_???.csv"],
+        scan_interval_tables),
+    "scan_intervals_single_channel": (["scan intervals single channel/??.csv",
+        "scan intervals single channel/all.csv"], single_channel_tables),
+}
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    arg_parser = argparse.ArgumentParser(
+        description="compute the FA16 loss, RSSI, SD and ordering tables as CSV files")
+    arg_parser.add_argument("experiments",
+        help="experiments to tabulate (default: all of {})".format(", ".join(EXPERIMENTS)),
+        nargs="*")
+    arg_parser.add_argument("-d", "--data",
+        help="data directory",
+        default=os.path.join(here, "data"))
+    arg_parser.add_argument("-o", "--outdir",
+        help="directory to write the tables to",
+        default=os.path.join(here, "analysis"))
+    arg_parser.add_argument("-j", "--jobs",
+        help="number of processes (default: one per core)",
+        type=int)
+    args = arg_parser.parse_args()
+
+    experiments = args.experiments or list(EXPERIMENTS)
+    for experiment in experiments:
+        if experiment not in EXPERIMENTS:
+            arg_parser.error("unknown experiment: {}".format(experiment))
+    paths = dict((experiment, [path for pattern in EXPERIMENTS[experiment][0]
+            for path in sorted(glob.glob(os.path.join(args.data, pattern)))])
+        for experiment in experiments)
+    results = analyze_files(sorted(set(sum(paths.values(), []))), args.jobs)
+    os.makedirs(args.outdir, exist_ok=True)
+    for experiment in experiments:
+        tables = EXPERIMENTS[experiment][1](dict((path, results[path])
+            for path in paths[experiment]))
+        for table, rows in tables.items():
+            with open(os.path.join(args.outdir, table + ".csv"), "w", newline="") as f:
+                csv.writer(f).writerows(rows)
+            print("Wrote {} ({} rows)".format(table + ".csv", len(rows) - 1))
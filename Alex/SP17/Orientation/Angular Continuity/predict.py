@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
 # import argparse
+import sys
 import os
-import csv
-import statistics as st
 import numpy as np
-import numpy.linalg as la
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from dataset import load_dataset
+from model import Model
 
 # arg_parser = argparse.ArgumentParser()
 # arg_parser.add_argument("--angle", "-a",
@@ -17,92 +18,47 @@ import numpy.linalg as la
 # args = arg_parser.parse_args()
 
 
-def __freq_to_channel_num(freq):
-    ''' Map frequency (24xx MHz) to advertising channel number. '''
-    if freq == 2:
-        return 37
-    elif freq == 26:
-        return 38
-    elif freq == 80:
-        return 39
-    else:
-        return -1
-
-def parse_csv(f):
-    ''' Parse the CSV-formatted file or serial port output. '''
-    datapoints = []
-    reader = csv.reader(f)
-    timestamp_offset = None
-    for row in reader:
-        dp = {}
-        dp["tag_id"] = int(row[0])
-        dp["sequence_num"] = int(row[1])
-        if timestamp_offset == None:
-            timestamp_offset = int(row[2])
-        dp["timestamp"] = int(row[2]) - timestamp_offset
-        dp["rssi"] = int(row[3])
-        dp["channel"] = __freq_to_channel_num(int(row[4]))
-        datapoints.append(dp)
-    return datapoints
-
-
 training_datapoints = {}
 
-for subdir in os.scandir("./Multiple distances"):
-    if not subdir.is_dir():
-        continue
-    distance = int(subdir.name[0:2])
-    angle = float(subdir.name[7:-4])
-    with open(os.path.join(subdir.path, "raw.csv")) as f:
-        if not angle in training_datapoints:
-            training_datapoints[angle] = {}
-        training_datapoints[angle][distance] = parse_csv(f)
+for capture, dps in load_dataset("./Multiple distances").items():
+    if not capture.angle in training_datapoints:
+        training_datapoints[capture.angle] = {}
+    training_datapoints[capture.angle][capture.radius] = dps
 
 measured_datapoints = {}
 
-for subdir in os.scandir("./One distance"):
-    if not subdir.is_dir():
-        continue
-    angle = float(subdir.name[:-4])
-    with open(os.path.join(subdir.path, "raw.csv")) as f:
-        measured_datapoints[angle] = parse_csv(f)
+for capture, dps in load_dataset("./One distance").items():
+    measured_datapoints[capture.angle] = dps
 
 
 channels = [37, 38, 39]
 angles = sorted(list(training_datapoints.keys()))
 distances = sorted(list(training_datapoints[0.0].keys()))
 
-model = \
-    dict([(angle,
-        dict([(dist,
-            tuple(st.mean([dp["rssi"] for dp in
-                training_datapoints[angle][dist] if dp["channel"] == ch])
-            for ch in channels))
-        for dist in distances]))
-    for angle in angles])
+# The tags' orientation is the model's orientation axis; azimuth is fixed
+model = Model(channels)
+for angle in angles:
+    for dist in distances:
+        model.add_cells(dist, 0, angle,
+            [float(np.mean(training_datapoints[angle][dist].select(channel=ch).rssi))
+                for ch in channels])
 
-measured = \
-    dict([(angle,
-        tuple(st.mean([dp["rssi"] for dp in
-            measured_datapoints[angle] if dp["channel"] == ch])
-        for ch in channels))
-    for angle in angles])
+measured = [
+    [float(np.mean(measured_datapoints[angle].select(channel=ch).rssi)) for ch in channels]
+    for angle in angles]
 
 print("Distance predictions:")
-for angle in measured:
-    norms = dict([(dist,
-        la.norm(np.subtract(measured[angle], model[angle][dist]), ord=2))
-        for dist in distances])
-    predicted_distance = min(norms, key=norms.get)
-    print("{:3} deg: {} cm".format(int(angle), predicted_distance))
+predicted = model.predict_batch(measured, free_axes=["radius"], ord=2,
+    azimuth=0, orientation=angles)
+for angle, predicted_distance in zip(angles, predicted.best[:, 0].tolist()):
+    print("{:3} deg: {} cm".format(int(angle), int(predicted_distance)))
 
 print()
 print("Orientation predictions:")
-for actual_angle in angles:
-    norms = dict([(angle,
-        la.norm(np.subtract(measured[actual_angle], model[angle][20]), ord=4))
-        for angle in angles])
-    predicted_angle = min(norms, key=norms.get)
-    predictions = [int(i) for i in sorted(norms, key=norms.get)]
+predicted = model.predict_batch(measured, free_axes=["orientation"], ord=4, k=len(angles),
+    radius=20, azimuth=0)
+for actual_angle, ranked in zip(angles, predicted.values[:, :, 2].tolist()):
+    predicted_angle = ranked[0]
+    predictions = [int(i) for i in ranked]
     print("Actual: {:3} deg, Predicted: {}".format(int(actual_angle), predictions))
     # print("Actual: {:3} deg, Predicted: {:3} deg".format(int(actual_angle), int(predicted_angle)))
@@ -1,41 +1,22 @@
 #!/usr/bin/env python3
 
+import sys
 import argparse
 import os
 import re
-import csv
-import statistics as st
+import numpy as np
 import matplotlib.pyplot as plt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from dataset import load_dataset
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("chart",
     help="chart file to output")
 args = arg_parser.parse_args()
 
-def __freq_to_channel_num(freq):
-    ''' Map frequency (24xx MHz) to advertising channel number. '''
-    if freq == 2:
-        return 37
-    elif freq == 26:
-        return 38
-    elif freq == 80:
-        return 39
-    else:
-        return -1
-
-def __get_ids(arr):
+def __get_ids(datapoints):
     ''' Get a list of tag IDs that were detected. '''
-    def helper(arr):
-        if "tag_id" in arr:
-            return set([arr["tag_id"]])
-        ids = set()
-        for i in arr:
-            if hasattr(i, '__iter__'):
-                ids |= helper(i)
-            else:
-                ids |= helper(arr[i])
-        return ids
-    return sorted(list(helper(arr)))
+    return sorted(set().union(*[dps.get_ids() for dps in datapoints.values()]))
 
 def __tag_id_to_angle_offset(id):
     ''' Convert the tag number to the angle offset from 0 degrees '''
@@ -59,32 +40,10 @@ def __tag_id_to_angle_offset(id):
         raise ValueError("id must be an integer between 1 and 8")
 
 
-def parse_csv(f):
-    ''' Parse the CSV-formatted file or serial port output. '''
-    datapoints = []
-    reader = csv.reader(f)
-    timestamp_offset = None
-    for row in reader:
-        dp = {}
-        dp["tag_id"] = int(row[0])
-        dp["sequence_num"] = int(row[1])
-        if timestamp_offset == None:
-            timestamp_offset = int(row[2])
-        dp["timestamp"] = int(row[2]) - timestamp_offset
-        dp["rssi"] = int(row[3])
-        dp["channel"] = __freq_to_channel_num(int(row[4]))
-        datapoints.append(dp)
-    return datapoints
-
-
 datapoints = {}
 
-for subdir in os.scandir():
-    if not subdir.is_dir():
-        continue
-    angle = float(subdir.name[:-4])
-    with open(os.path.join(subdir.path, "raw.csv")) as f:
-        datapoints[angle] = parse_csv(f)
+for capture, dps in load_dataset().items():
+    datapoints[capture.angle] = dps
 
 # Connect the two sides of the plot
 datapoints[360.0] = datapoints[0.0]
@@ -98,9 +57,9 @@ for angle in datapoints:
     channel_avgs.append(
         (angle, dict([
             (ch,
-                st.mean([dp["rssi"] for tag in ids for dp in
-                    datapoints[(__tag_id_to_angle_offset(tag) - angle) % 360.0]
-                    if dp["channel"] == ch and dp["tag_id"] == tag]))
+                np.mean(np.concatenate([datapoints[
+                    (__tag_id_to_angle_offset(tag) - angle) % 360.0].select(
+                        tag=tag, channel=ch).rssi for tag in ids])))
             for ch in channels])))
 channel_avgs = sorted(channel_avgs, key=lambda x: x[0])
 
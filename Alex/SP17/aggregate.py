@@ -0,0 +1,614 @@
+import collections
+import math
+import numpy as np
+from datapoints import CHANNELS
+
+
+class GroupStats:
+    ''' RSSI count, mean, variance, min and max per (tag, channel).
+
+    Arrays indexed [tag, channel] have one row per entry of `ids` and one
+    column per entry of `channels`; the `tag_*` arrays hold the totals
+    over every channel, including packets on unknown channels. Groups with
+    no packets have NaN statistics, and groups with one packet NaN variance.
+    '''
+    def __init__(self, ids, channels, count, total, total_sq, minimum, maximum):
+        self.ids = ids
+        self.channels = channels
+        # The last channel column collects packets on any other channel
+        self.count = count[:, :-1]
+        self.tag_count = count.sum(axis=1)
+        self.mean, self.var = self.__moments(count, total, total_sq)
+        self.mean, self.var = self.mean[:, :-1], self.var[:, :-1]
+        self.tag_mean, self.tag_var = self.__moments(
+            self.tag_count, total.sum(axis=1), total_sq.sum(axis=1))
+        self.min = minimum[:, :-1]
+        self.max = maximum[:, :-1]
+        self.tag_min = np.where(count > 0, minimum, np.inf).min(axis=1)
+        self.tag_max = np.where(count > 0, maximum, -np.inf).max(axis=1)
+
+    @staticmethod
+    def __moments(count, total, total_sq):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, total / count, np.nan)
+            m2 = np.maximum(total_sq - total * mean, 0.0)
+            var = np.where(count > 1, m2 / (count - 1), np.nan)
+        return mean, var
+
+    @property
+    def sd(self):
+        return np.sqrt(self.var)
+
+    @property
+    def tag_sd(self):
+        return np.sqrt(self.tag_var)
+
+
+def group_stats(datapoints, channels=CHANNELS, rssi=None):
+    ''' Compute RSSI statistics for every (tag, channel) in one pass.
+
+    `rssi` stands in for datapoints.rssi if given, e.g. filtered values
+    (see filters.filter_rssi).
+    '''
+    num_tags = len(datapoints.ids)
+    num_slots = len(channels) + 1
+    slot = np.full(256, len(channels), dtype=np.int64)
+    slot[channels] = np.arange(len(channels))
+    keys = datapoints.tag_index.astype(np.int64) * num_slots + slot[datapoints.channel]
+    shape = (num_tags, num_slots)
+
+    if rssi is not None:
+        rssi = np.asarray(rssi, dtype=np.float64)
+        size = num_tags * num_slots
+        count = np.bincount(keys, minlength=size).reshape(shape)
+        total = np.bincount(keys, weights=rssi, minlength=size).reshape(shape)
+        total_sq = np.bincount(keys, weights=rssi * rssi, minlength=size).reshape(shape)
+        minimum = np.full(size, np.inf)
+        maximum = np.full(size, -np.inf)
+        np.minimum.at(minimum, keys, rssi)
+        np.maximum.at(maximum, keys, rssi)
+        minimum = np.where(count > 0, minimum.reshape(shape), np.nan)
+        maximum = np.where(count > 0, maximum.reshape(shape), np.nan)
+        return GroupStats(datapoints.get_ids(), list(channels), count, total,
+            total_sq, minimum, maximum)
+
+    # RSSI is int8, so one bincount gives a full histogram of every group,
+    # from which all of the statistics follow without another pass
+    levels = np.arange(-128, 128, dtype=np.float64)
+    hist = np.bincount(keys * 256 + (datapoints.rssi.astype(np.int64) + 128),
+        minlength=num_tags * num_slots * 256).reshape(shape + (256,))
+    count = hist.sum(axis=2)
+    total = hist @ levels
+    total_sq = hist @ (levels * levels)
+    seen = hist > 0
+    minimum = np.where(count > 0, levels[seen.argmax(axis=2)], np.nan)
+    maximum = np.where(count > 0, levels[255 - seen[..., ::-1].argmax(axis=2)], np.nan)
+
+    return GroupStats(datapoints.get_ids(), list(channels), count, total,
+        total_sq, minimum, maximum)
+
+
+class Loss:
+    ''' Packet loss per tag, per (tag, channel) and per (tag, time window).
+
+    `expected` and `received` hold one count per entry of `ids`;
+    `channel_received` is indexed [tag, channel], and the `window_*`
+    arrays [tag, window], for windows starting at the times in `windows`
+    (milliseconds). Every advertising event is sent on each channel, so a
+    channel's loss is taken against its tag's expected count. Loss rates
+    are NaN where nothing was expected.
+    '''
+    def __init__(self, ids, channels, expected, received, channel_received,
+                 windows=None, window_expected=None, window_received=None):
+        self.ids = ids
+        self.channels = channels
+        self.expected = expected
+        self.received = received
+        self.channel_received = channel_received
+        self.windows = windows
+        self.window_expected = window_expected
+        self.window_received = window_received
+        self.loss = self.__rate(received, expected)
+        self.channel_loss = self.__rate(channel_received, expected[:, None])
+        self.window_loss = None if windows is None else self.__rate(window_received, window_expected)
+
+    @staticmethod
+    def __rate(received, expected):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(expected > 0, 1 - received / expected, np.nan)
+
+
+class LossCounter:
+    ''' Packet loss counted over a stream of packets, a chunk at a time.
+
+    A tag's first packet counts as one sent, and each later one as the
+    number of steps its sequence number moved on, modulo 256. `repeats`
+    says what a repeated sequence number is: "packet", one more packet
+    sent (as the loss has always been counted), or "event", the same
+    advertising event heard again, e.g. on another channel, which adds
+    to neither the expected nor the received count, nor to the count of
+    a channel it was already heard on. With `window` (milliseconds) the
+    counts are also kept per time window.
+
+    Each tag's packets must be given in the order they arrived, but
+    chunks can be of any size, so whole captures and live streams are
+    counted alike.
+    '''
+    REPEATS = ["packet", "event"]
+
+    def __init__(self, repeats="packet", window=None, channels=CHANNELS):
+        if repeats not in self.REPEATS:
+            raise ValueError("unknown treatment of repeats: {}".format(repeats))
+        self.repeats = repeats
+        self.window = window
+        self.channels = list(channels)
+        self.slot = np.full(256, len(self.channels), dtype=np.int64)
+        self.slot[self.channels] = np.arange(len(self.channels))
+        self.last_seq = {}
+        # Bit mask of the channel slots each tag's latest event was heard on
+        self.heard = {}
+        self.expected = {}
+        self.received = {}
+        self.channel_received = {}
+        self.window_counts = {}
+
+    def update(self, tag_id, sequence_num, timestamp=None, channel=None):
+        ''' Count a chunk of packets, given as arrays.
+
+        Returns what each packet added to its tag's expected and received
+        counts. `timestamp` is needed only with a window, and `channel`
+        only for the per-channel counts.
+        '''
+        tag_id = np.asarray(tag_id, dtype=np.int64)
+        n = len(tag_id)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        num_channels = len(self.channels)
+        order = np.argsort(tag_id, kind="stable")
+        tags = tag_id[order]
+        seq = np.asarray(sequence_num, dtype=np.int64)[order]
+        slot = np.full(n, num_channels, dtype=np.int64) if channel is None \
+            else self.slot[np.asarray(channel, dtype=np.int64)[order]]
+
+        first = np.ones(n, dtype=bool)
+        first[1:] = tags[1:] != tags[:-1]
+        starts = np.flatnonzero(first)
+        ends = np.append(starts[1:], n) - 1
+        tag_pos = np.cumsum(first) - 1
+        ids = tags[starts].tolist()
+
+        # Each tag's first packet follows on from the last chunk's
+        prev = np.empty(n, dtype=np.int64)
+        prev[1:] = seq[:-1]
+        prev[starts] = [self.last_seq.get(tag, -1) for tag in ids]
+        known = prev >= 0
+        step = np.where(known, (seq - prev) % 256, 1)
+        repeat = known & (step == 0)
+
+        if self.repeats == "packet":
+            step[repeat] = 1
+            received = np.ones(n, dtype=np.int64)
+            channel_new = slot < num_channels
+            heard = None
+        else:
+            received = (~repeat).astype(np.int64)
+            # Number every event; a tag's packets up to its first new
+            # sequence number continue the event the last chunk ended on
+            event = np.cumsum(~repeat | first)
+            continuing = repeat[starts][tag_pos] & (event == event[starts][tag_pos])
+            heard = np.array([self.heard.get(tag, 0) for tag in ids], dtype=np.int64)
+            channel_new = np.zeros(n, dtype=bool)
+            channel_new[np.unique(event * (num_channels + 1) + slot, return_index=True)[1]] = True
+            channel_new &= ~(continuing & ((heard[tag_pos] >> slot) & 1).astype(bool))
+            channel_new &= slot < num_channels
+            last_event = event == event[ends][tag_pos]
+            bits = np.where(continuing[ends], heard, 0)
+            np.bitwise_or.at(bits, tag_pos[last_event], np.left_shift(1, slot[last_event]))
+            heard = bits.tolist()
+
+        expected = np.add.reduceat(step, starts).tolist()
+        received_total = np.add.reduceat(received, starts).tolist()
+        channel_counts = np.bincount(tag_pos[channel_new] * num_channels + slot[channel_new],
+            minlength=len(ids) * num_channels).reshape(len(ids), num_channels)
+        last_seq = seq[ends].tolist()
+        for i, tag in enumerate(ids):
+            self.last_seq[tag] = last_seq[i]
+            if heard is not None:
+                self.heard[tag] = heard[i]
+            self.expected[tag] = self.expected.get(tag, 0) + expected[i]
+            self.received[tag] = self.received.get(tag, 0) + received_total[i]
+            if tag in self.channel_received:
+                self.channel_received[tag] += channel_counts[i]
+            else:
+                self.channel_received[tag] = channel_counts[i].copy()
+
+        if self.window is not None:
+            index = np.asarray(timestamp, dtype=np.int64)[order] // int(self.window)
+            keys, inverse = np.unique(np.stack([tag_pos, index]), axis=1, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            window_expected = np.bincount(inverse, weights=step).astype(np.int64).tolist()
+            window_received = np.bincount(inverse, weights=received).astype(np.int64).tolist()
+            for (pos, w), e, r in zip(keys.T.tolist(), window_expected, window_received):
+                counts = self.window_counts.setdefault((ids[pos], w), [0, 0])
+                counts[0] += e
+                counts[1] += r
+
+        packet_expected = np.empty(n, dtype=np.int64)
+        packet_expected[order] = step
+        packet_received = np.empty(n, dtype=np.int64)
+        packet_received[order] = received
+        return packet_expected, packet_received
+
+    def add(self, tag_id, sequence_num, timestamp=None, channel=None):
+        ''' Count one packet; returns what it added to the expected and received counts.
+
+        Counts as update does, without its array overhead, for live streams.
+        '''
+        num_channels = len(self.channels)
+        slot = num_channels if channel is None else int(self.slot[channel])
+        prev = self.last_seq.get(tag_id)
+        step = 1 if prev is None else (sequence_num - prev) % 256
+        repeat = prev is not None and step == 0
+        channel_new = slot < num_channels
+        if self.repeats == "packet":
+            step = step or 1
+            received = 1
+        else:
+            received = 0 if repeat else 1
+            heard = self.heard.get(tag_id, 0) if repeat else 0
+            channel_new &= not (heard >> slot) & 1
+            self.heard[tag_id] = heard | (1 << slot)
+
+        self.last_seq[tag_id] = sequence_num
+        self.expected[tag_id] = self.expected.get(tag_id, 0) + step
+        self.received[tag_id] = self.received.get(tag_id, 0) + received
+        if tag_id not in self.channel_received:
+            self.channel_received[tag_id] = np.zeros(num_channels, dtype=np.int64)
+        if channel_new:
+            self.channel_received[tag_id][slot] += 1
+        if self.window is not None:
+            counts = self.window_counts.setdefault((tag_id, timestamp // int(self.window)), [0, 0])
+            counts[0] += step
+            counts[1] += received
+        return step, received
+
+    def result(self, ids=None):
+        ''' The counts so far as a Loss, for `ids` (default: every tag seen). '''
+        ids = sorted(self.expected) if ids is None else list(ids)
+        num_channels = len(self.channels)
+        expected = np.array([self.expected.get(tag, 0) for tag in ids], dtype=np.int64)
+        received = np.array([self.received.get(tag, 0) for tag in ids], dtype=np.int64)
+        channel_received = np.array([self.channel_received.get(tag, np.zeros(num_channels, np.int64))
+            for tag in ids], dtype=np.int64).reshape(len(ids), num_channels)
+        if self.window is None:
+            return Loss(ids, self.channels, expected, received, channel_received)
+        indices = sorted(set(w for _, w in self.window_counts))
+        column = dict((w, j) for j, w in enumerate(indices))
+        row = dict((tag, i) for i, tag in enumerate(ids))
+        window_expected = np.zeros((len(ids), len(indices)), dtype=np.int64)
+        window_received = np.zeros_like(window_expected)
+        for (tag, w), (e, r) in self.window_counts.items():
+            if tag in row:
+                window_expected[row[tag], column[w]] = e
+                window_received[row[tag], column[w]] = r
+        return Loss(ids, self.channels, expected, received, channel_received,
+            np.array(indices, dtype=np.int64) * int(self.window), window_expected, window_received)
+
+
+def packet_loss(datapoints, repeats="packet", window=None, channels=CHANNELS):
+    ''' Packet loss of every tag, per channel and per time window, in one pass.
+
+    See LossCounter for `repeats` and `window`. The result's rows follow
+    datapoints.ids.
+    '''
+    counter = LossCounter(repeats, window, channels)
+    counter.update(datapoints.tag_id, datapoints.sequence_num, datapoints.timestamp,
+        datapoints.channel)
+    return counter.result(datapoints.get_ids())
+
+
+def expected_counts(datapoints):
+    ''' Number of packets each tag sent, inferred from its sequence numbers.
+
+    Sequence numbers wrap around at 256, and a repeated sequence number
+    counts as one more packet.
+    '''
+    return packet_loss(datapoints, channels=[]).expected
+
+
+class TimeBins:
+    ''' Mean RSSI and packet count per fixed-width time bin.
+
+    `times` holds the start of every bin (milliseconds), from the first
+    packet's to the last's, and `columns` the tag ID of every column, or
+    its (tag ID, channel) when split by channel. `mean` and `count` are
+    indexed [bin, column]. Means are NaN in bins with no packets, unless
+    filled forward from the last bin that had some.
+    '''
+    def __init__(self, bin_size, times, columns, mean, count):
+        self.bin_size = bin_size
+        self.times = times
+        self.columns = columns
+        self.mean = mean
+        self.count = count
+
+
+def time_bins(datapoints, bin_size=100, by_channel=False, fill=False, channels=CHANNELS):
+    ''' Pivot the packets into time bins of every tag, or tag and channel, in one pass.
+
+    Packets on channels other than `channels` are left out when split by
+    channel.
+    '''
+    ids = datapoints.get_ids()
+    column = datapoints.tag_index.astype(np.int64)
+    keep = np.ones(len(column), dtype=bool)
+    columns = ids
+    if by_channel:
+        slot = np.full(256, -1, dtype=np.int64)
+        slot[channels] = np.arange(len(channels))
+        packet_slot = slot[datapoints.channel]
+        keep = packet_slot >= 0
+        column = column * len(channels) + packet_slot
+        columns = [(tag, ch) for tag in ids for ch in channels]
+    num_columns = len(columns)
+
+    index = datapoints.timestamp.astype(np.int64) // bin_size
+    start = int(index.min()) if len(index) else 0
+    num_bins = int(index.max()) - start + 1 if len(index) else 0
+    keys = (index[keep] - start) * num_columns + column[keep]
+    shape = (num_bins, num_columns)
+    count = np.bincount(keys, minlength=num_bins * num_columns).reshape(shape)
+    total = np.bincount(keys, weights=datapoints.rssi[keep],
+        minlength=num_bins * num_columns).reshape(shape)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+    if fill and num_bins:
+        # Each bin takes the mean of the latest bin at or before it with packets
+        latest = np.maximum.accumulate(np.where(count > 0, np.arange(num_bins)[:, None], 0), axis=0)
+        mean = mean[latest, np.arange(num_columns)]
+    times = (start + np.arange(num_bins, dtype=np.int64)) * bin_size
+    return TimeBins(bin_size, times, columns, mean, count)
+
+
+# Advertising interval the tags are programmed with (milliseconds)
+ADVERTISING_INTERVAL = 100
+
+
+class Timing:
+    ''' Every tag's advertising period, fitted with its drift and jitter.
+
+    Each tag's timestamps are regressed on its unwrapped sequence numbers:
+    `period` (milliseconds per advertising event) and `offset` are the
+    fit, and `drift` how far the period is from `nominal`, in parts per
+    million. `jitter` has one row per tag and one column per entry of
+    `percentiles`, the percentiles of the residuals' magnitude.
+    `events` and `residuals` hold every packet's unwrapped sequence number
+    and residual (ms), in the order of the packets. Tags heard in fewer
+    than two advertising events have NaN fits.
+    '''
+    def __init__(self, ids, nominal, percentiles, period, offset, jitter, events, residuals):
+        self.ids = ids
+        self.nominal = nominal
+        self.percentiles = percentiles
+        self.period = period
+        self.offset = offset
+        self.drift = (period / nominal - 1) * 1e6
+        self.jitter = jitter
+        self.events = events
+        self.residuals = residuals
+
+
+def advertising_timing(datapoints, nominal=ADVERTISING_INTERVAL, percentiles=(50, 95, 99)):
+    ''' Fit every tag's advertising period by least squares, in one pass.
+
+    Sequence numbers are unwrapped as LossCounter counts events, with a
+    repeat taken as the same event, and all of the tags' regressions are
+    solved at once from grouped sums.
+    '''
+    num_tags = len(datapoints.ids)
+    steps, _ = LossCounter("event", channels=[]).update(datapoints.tag_index, datapoints.sequence_num)
+    order = np.argsort(datapoints.tag_index, kind="stable")
+    tags = datapoints.tag_index[order].astype(np.int64)
+    first = np.ones(len(tags), dtype=bool)
+    first[1:] = tags[1:] != tags[:-1]
+    starts = np.flatnonzero(first)
+    tag_pos = np.cumsum(first) - 1
+    unwrapped = np.cumsum(steps[order])
+    unwrapped -= unwrapped[starts][tag_pos]
+    x = unwrapped.astype(np.float64)
+    y = datapoints.timestamp[order].astype(np.float64)
+
+    count = np.bincount(tags, minlength=num_tags)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = np.bincount(tags, weights=x, minlength=num_tags) / count
+        mean_y = np.bincount(tags, weights=y, minlength=num_tags) / count
+        dx = x - mean_x[tags]
+        sxx = np.bincount(tags, weights=dx * dx, minlength=num_tags)
+        sxy = np.bincount(tags, weights=dx * (y - mean_y[tags]), minlength=num_tags)
+        period = np.where(sxx > 0, sxy / sxx, np.nan)
+    offset = mean_y - period * mean_x
+    residuals = y - offset[tags] - period[tags] * x
+
+    # Percentiles of each tag's sorted magnitudes, interpolated as np.percentile does
+    magnitude = np.abs(residuals)
+    magnitude = magnitude[np.lexsort((magnitude, tags))]
+    position = (np.cumsum(count) - count)[:, None] + \
+        np.maximum(count - 1, 0)[:, None] * np.asarray(percentiles, dtype=np.float64) / 100.0
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    jitter = magnitude[lower] + (magnitude[upper] - magnitude[lower]) * (position - lower)
+    jitter[np.isnan(period)] = np.nan
+
+    events = np.empty(len(tags), dtype=np.int64)
+    events[order] = unwrapped
+    packet_residuals = np.empty(len(tags))
+    packet_residuals[order] = residuals
+    return Timing(datapoints.get_ids(), nominal, list(percentiles), period, offset, jitter,
+        events, packet_residuals)
+
+
+class RunningStat:
+    ''' Running count, mean and variance of a value (Welford's method). '''
+    __slots__ = ["count", "mean", "m2"]
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        ''' Fold another running statistic into this one. '''
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else float("nan")
+
+
+class StreamingStats:
+    ''' Constant-memory RSSI and loss statistics over a packet stream.
+
+    Packets are folded into cumulative per-(tag, channel) aggregates and
+    into fixed-width time buckets, of which only enough to cover the
+    sliding window are kept. Times are packet timestamps in milliseconds.
+    Loss is counted by a LossCounter, with `repeats` treated as it says.
+    '''
+    def __init__(self, window=10000, bucket=1000, channels=CHANNELS, repeats="packet"):
+        self.window = window
+        self.bucket = bucket
+        self.channels = list(channels)
+        self.rssi = {}
+        self.loss = {}
+        self.counter = LossCounter(repeats, channels=channels)
+        self.buckets = {}
+        self.latest = None
+
+    def add(self, tag_id, sequence_num, timestamp, rssi, channel):
+        ''' Update the aggregates with one received packet. '''
+        step, received = self.counter.add(tag_id, sequence_num, channel=channel)
+
+        index = timestamp // self.bucket
+        if index not in self.buckets:
+            self.buckets[index] = ({}, {})
+            self.latest = index if self.latest is None else max(self.latest, index)
+            oldest = self.latest - self.window // self.bucket
+            for old in [i for i in self.buckets if i <= oldest]:
+                del self.buckets[old]
+        for rssi_stats, loss in [(self.rssi, self.loss)] + \
+                ([self.buckets[index]] if index in self.buckets else []):
+            rssi_stats.setdefault((tag_id, channel), RunningStat()).add(rssi)
+            counts = loss.setdefault(tag_id, [0, 0])
+            counts[0] += received
+            counts[1] += step
+
+    def summary(self, window=False):
+        ''' Statistics in the same shape as calculate_stats returns, less the
+        per-channel loss and advertising timing.
+
+        With window=True only the packets in the sliding window are used.
+        '''
+        if window:
+            rssi_stats, loss = {}, {}
+            for bucket_rssi, bucket_loss in self.buckets.values():
+                for key, stat in bucket_rssi.items():
+                    rssi_stats.setdefault(key, RunningStat()).merge(stat)
+                for tag, (received, expected) in bucket_loss.items():
+                    counts = loss.setdefault(tag, [0, 0])
+                    counts[0] += received
+                    counts[1] += expected
+        else:
+            rssi_stats, loss = self.rssi, self.loss
+
+        ids = sorted(loss)
+        totals = dict((tag, RunningStat()) for tag in ids)
+        for (tag, ch), stat in rssi_stats.items():
+            totals[tag].merge(RunningStat(stat.count, stat.mean, stat.m2))
+
+        def by_ch(tag, fn):
+            return dict((ch, round(fn(rssi_stats.get((tag, ch), RunningStat())), 3))
+                for ch in self.channels)
+
+        def mean(stat):
+            return stat.mean if stat.count else float("nan")
+
+        stats = {}
+        stats["num_received"] = dict((tag, loss[tag][0]) for tag in ids)
+        stats["num_expected"] = dict((tag, loss[tag][1]) for tag in ids)
+        # NaN, as in Loss, where nothing was expected: a window in which a
+        # tag only repeated an event it was already counted for
+        stats["loss_rate"] = dict((tag, round(1 - loss[tag][0]/loss[tag][1], 3) if loss[tag][1]
+            else float("nan")) for tag in ids)
+        stats["rssi_avg"] = dict((tag, round(totals[tag].mean, 3)) for tag in ids)
+        stats["rssi_sd"] = dict((tag, round(math.sqrt(totals[tag].var), 3)) for tag in ids)
+        stats["rssi_avg_by_ch"] = dict((tag, by_ch(tag, mean)) for tag in ids)
+        stats["rssi_sd_by_ch"] = dict((tag, by_ch(tag, lambda s: math.sqrt(s.var))) for tag in ids)
+        stats["predicted_order_naive"] = sorted(stats["rssi_avg"], key=stats["rssi_avg"].get, reverse=True)
+        return stats
+
+
+class SlidingMeans:
+    ''' Per-(tag, channel) RSSI means over the packets of the last `window` seconds.
+
+    Packets must be added in time order. Each is kept until it leaves the
+    window, next to running sums per group, so adding and expiring a
+    packet take constant time. Packets on other channels are ignored.
+    '''
+    def __init__(self, window=1.0, channels=CHANNELS):
+        self.window = window
+        self.channels = list(channels)
+        self.slot = dict((ch, i) for i, ch in enumerate(self.channels))
+        self.packets = collections.deque()
+        self.count = {}
+        self.total = {}
+        self.newest = {}
+
+    def add(self, time, tag_id, rssi, channel):
+        ''' Add a packet received at `time` seconds. '''
+        slot = self.slot.get(channel)
+        if slot is None:
+            return
+        if tag_id not in self.count:
+            self.count[tag_id] = [0] * len(self.channels)
+            self.total[tag_id] = [0] * len(self.channels)
+        self.packets.append((time, tag_id, slot, rssi))
+        self.count[tag_id][slot] += 1
+        self.total[tag_id][slot] += rssi
+        self.newest[tag_id] = time
+        self.expire(time)
+
+    def expire(self, now):
+        ''' Drop the packets received `window` seconds or more before now. '''
+        oldest = now - self.window
+        while self.packets and self.packets[0][0] <= oldest:
+            _, tag_id, slot, rssi = self.packets.popleft()
+            self.count[tag_id][slot] -= 1
+            self.total[tag_id][slot] -= rssi
+
+    def means(self, now=None):
+        ''' Current means of the tags with packets in the window.
+
+        Returns (ids, mean, count, newest): the tag IDs, their mean RSSI and
+        packet count per channel (NaN mean where there are none) and the
+        time of each tag's newest packet.
+        '''
+        if now is not None:
+            self.expire(now)
+        ids = sorted(tag for tag, count in self.count.items() if any(count))
+        count = np.array([self.count[tag] for tag in ids], dtype=np.int64).reshape(-1, len(self.channels))
+        total = np.array([self.total[tag] for tag in ids], dtype=np.float64).reshape(count.shape)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, total / count, np.nan)
+        return ids, mean, count, np.array([self.newest[tag] for tag in ids])
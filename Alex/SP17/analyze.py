@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
 import os
-import io
 import time
 import serial
 import csv
-import statistics as st
+import numpy as np
 import matplotlib.pyplot as plt
+import calibration
+import capture
+from capture_log import CaptureLogWriter, read_capture_log
+from datapoints import CHANNELS, DataPoints, calibrated, freq_to_channel_num, read_csv, \
+    read_psd, write_processed, write_table
+from aggregate import LossCounter, StreamingStats, advertising_timing, group_stats, packet_loss, \
+    time_bins
+from filters import FILTERS, StreamingFilter, filter_rssi, make_filters
 
 
 class __BinaryToText:
@@ -22,62 +30,46 @@ class __BinaryToText:
         return self.f.readline().decode("ascii")
 
 
-def __freq_to_channel_num(freq):
-    ''' Map frequency (24xx MHz) to advertising channel number. '''
-    if freq == 2:
-        return 37
-    elif freq == 26:
-        return 38
-    elif freq == 80:
-        return 39
-    else:
-        return -1
-
-
-def __get_ids(arr):
+def __get_ids(datapoints):
     ''' Get a list of tag IDs that were detected. '''
-    def helper(arr):
-        if "tag_id" in arr:
-            return set([arr["tag_id"]])
-        ids = set()
-        for i in arr:
-            if hasattr(i, '__iter__'):
-                ids |= helper(i)
-            else:
-                ids |= helper(arr[i])
-        return ids
-    return sorted(list(helper(arr)))
+    return datapoints.get_ids()
+
 
+def calculate_stats(datapoints, repeats="packet", rssi_filter=None):
+    ''' Calculate various statistics on the data set.
 
-def calculate_stats(datapoints):
-    ''' Calculate various statistics on the data set. '''
+    `repeats` is how repeated sequence numbers are counted (see
+    aggregate.LossCounter). RSSI statistics are of the values run
+    through `rssi_filter`, a list of filters (see filters.py), if given.
+    '''
     stats = {}
     ids = __get_ids(datapoints)
-    seq_num_received = dict([(tag, [dp["sequence_num"] for dp in datapoints if dp["tag_id"] == tag]) for tag in ids])
-    stats["num_received"] = dict([(key, len(seq_num_received[key])) for key in seq_num_received])
-    stats["num_expected"] = dict([(key, 1) for key in seq_num_received])
-    for key in seq_num_received:
-        prev = seq_num_received[key][0]
-        for curr in seq_num_received[key][1:]:
-            if curr > prev:
-                stats["num_expected"][key] += curr - prev
-            elif curr < prev:
-                stats["num_expected"][key] += curr - prev + 256
-            else:
-                stats["num_expected"][key] += 1
-            prev = curr
+    groups = group_stats(datapoints, rssi=filter_rssi(datapoints, rssi_filter) if rssi_filter else None)
+    loss = packet_loss(datapoints, repeats)
+    stats["num_received"] = dict(zip(ids, loss.received.tolist()))
+    stats["num_expected"] = dict(zip(ids, loss.expected.tolist()))
     stats["loss_rate"] = dict([(tag, round(1-stats["num_received"][tag]/stats["num_expected"][tag], 3)) for tag in ids])
 
-    def fn_over_rssi(fn):
-        return dict([(tag, round(fn([dp["rssi"] for dp in datapoints if dp["tag_id"] == tag]), 3)) for tag in ids])
+    def by_tag(values):
+        return dict(zip(ids, np.round(values, 3).tolist()))
+
+    def by_tag_and_ch(values):
+        return dict(zip(ids, [dict(zip(groups.channels, row)) for row in np.round(values, 3).tolist()]))
 
-    def fn_over_rssi_and_ch(fn):
-        return dict([(tag, dict([(ch, round(fn([dp["rssi"] for dp in datapoints if dp["tag_id"] == tag and dp["channel"] == ch]), 3)) for ch in [37, 38, 39]])) for tag in ids])
+    stats["rssi_avg"] = by_tag(groups.tag_mean)
+    stats["rssi_sd"] = by_tag(groups.tag_sd)
+    stats["rssi_avg_by_ch"] = by_tag_and_ch(groups.mean)
+    stats["rssi_sd_by_ch"] = by_tag_and_ch(groups.sd)
+    stats["loss_rate_by_ch"] = by_tag_and_ch(loss.channel_loss)
 
-    stats["rssi_avg"] = fn_over_rssi(st.mean)
-    stats["rssi_sd"] = fn_over_rssi(st.stdev)
-    stats["rssi_avg_by_ch"] = fn_over_rssi_and_ch(st.mean)
-    stats["rssi_sd_by_ch"] = fn_over_rssi_and_ch(st.stdev)
+    # Advertising period and drift, fitted to the sequence numbers
+    timing = advertising_timing(datapoints)
+    stats["adv_period"] = by_tag(timing.period)
+    stats["adv_drift_ppm"] = dict(zip(ids, np.round(timing.drift).tolist()))
+    stats["adv_jitter"] = dict(zip(ids, [dict(zip(timing.percentiles, row))
+        for row in np.round(timing.jitter, 3).tolist()]))
+    stats["adv_residuals"] = dict((tag, timing.residuals[datapoints.tag_index == i])
+        for i, tag in enumerate(ids))
 
     stats["predicted_order_naive"] = sorted(stats["rssi_avg"], key=stats["rssi_avg"].get, reverse=True)
     
@@ -86,59 +78,15 @@ def calculate_stats(datapoints):
 
 def parse_psd(f, tag_id=None):
     ''' Parse the TI sniffer save file. '''
-    datapoints = []
-    while True:
-        b = f.read(1)
-        # Check for EOF
-        if not b:
-            break
-        # Skip nonstandard packets
-        if b != b"\x01":
-            f.seek(256, io.SEEK_CUR)
-            continue
-        
-        # Read out the data
-        # TODO: most of this is hardly used - only needed for keeping
-        # position while parsing. Try to optimize.
-        p = {}
-        p["info"] = ord(b)
-        p["num"] = int.from_bytes(f.read(4), byteorder="little")
-        p["timestamp"] = int.from_bytes(f.read(8), byteorder="little")
-        p["length"] = int.from_bytes(f.read(2), byteorder="little")
-        p["ble_length"] = ord(f.read(1))
-        p["ble_access_addr"] = [b for b in reversed(f.read(4))]
-        p["ble_header"] = int.from_bytes(f.read(2), byteorder="little")
-        p["ble_adv_addr"] = [b for b in reversed(f.read(6))]
-        p["ble_payload"] = f.read(p["ble_length"] - 17)
-        p["ble_crc"] = int.from_bytes(f.read(3), byteorder="little")
-        p["rssi"] = ord(f.read(1))
-        p["status"] = ord(f.read(1))
-        
-        # Convert the data
-        # Timestamp conversion from TI document # SWRU187G, page 23
-        timeLo = p["timestamp"] & 0xFFFF
-        timeHi = p["timestamp"] >> 16
-        p["timestamp"] = (timeHi * 5000 + timeLo)//32000
-        p["ble_seq_num"] = p["ble_payload"][2]
-        p["rssi"] = p["rssi"] - 94 # Conversion determined empirically
-        
-        # Build the data point
-        dp = {}
-        dp["tag_id"] = tag_id if tag_id is not None else int(p["ble_adv_addr"][-1])
-        dp["sequence_num"] = int(p["ble_seq_num"])
-        dp["timestamp"] = int(p["timestamp"])
-        dp["rssi"] = int(p["rssi"])
-        # TODO: determine channel packet was received on
-        datapoints.append(dp)
-        
-        # Skip to the next packet
-        f.seek(256 - p["length"], io.SEEK_CUR)
-    return datapoints
-
-
-def parse_csv(f, dumpfile=None, tag_id=None):
-    ''' Parse the CSV-formatted file or serial port output. '''
-    datapoints = []
+    return DataPoints(**read_psd(f, tag_id=tag_id))
+
+
+def parse_csv(f, dumpfile=None, tag_id=None, logwriter=None):
+    ''' Parse CSV-formatted serial port output as it arrives.
+
+    Packets are also appended to `logwriter`, a CaptureLogWriter, if given.
+    '''
+    columns = dict((key, array.array("q")) for key in DataPoints.COLUMNS)
     if dumpfile:
         writer = csv.writer(dumpfile)
     reader = csv.reader(f)
@@ -147,18 +95,85 @@ def parse_csv(f, dumpfile=None, tag_id=None):
     for row in reader:
         if dumpfile:
             writer.writerow(row)
-        dp = {}
-        dp["tag_id"] = tag_id if tag_id is not None else int(row[0])
-        dp["sequence_num"] = int(row[1])
+        columns["tag_id"].append(tag_id if tag_id is not None else int(row[0]))
+        columns["sequence_num"].append(int(row[1]))
         if timestamp_offset == None:
             timestamp_offset = int(row[2])
-        dp["timestamp"] = int(row[2]) - timestamp_offset
-        dp["rssi"] = int(row[3])
-        dp["channel"] = __freq_to_channel_num(int(row[4]))
-        datapoints.append(dp)
+            if logwriter:
+                logwriter.metadata["timestamp_offset"] = timestamp_offset
+        columns["timestamp"].append(int(row[2]) - timestamp_offset)
+        columns["rssi"].append(int(row[3]))
+        columns["channel"].append(freq_to_channel_num(int(row[4])))
+        if logwriter:
+            logwriter.append(*[columns[key][-1] for key in DataPoints.COLUMNS])
         if args.time != None and (time.time() - startTime) >= args.time:
             break
-    return datapoints
+    return calibrated(DataPoints(**columns))
+
+
+def print_stats(stats):
+    ''' Print a per-tag summary of the statistics. '''
+    for tag in sorted(stats["num_received"]):
+        print("Tag {}:".format(tag))
+        print("  Packets: {} of {}, loss: {:.3}%".format(stats["num_received"][tag],
+            stats["num_expected"][tag], float(stats["loss_rate"][tag])*100))
+        print("  RSSI avg: {:.3} dBm, stddev: {:.3} dBm".format(
+            float(stats["rssi_avg"][tag]), float(stats["rssi_sd"][tag])))
+        print("  RSSI avg by channel: {}".format(", ".join(
+            "{}: {:.3} dBm".format(ch, float(avg))
+            for ch, avg in stats["rssi_avg_by_ch"][tag].items())))
+    print("Detected order: {}".format("".join(map(str, stats["predicted_order_naive"]))))
+
+
+def print_running_stats(stats, elapsed):
+    ''' Print the sliding-window and cumulative summaries of a live capture. '''
+    print("=== {:.1f} s: last {:g} s ===".format(elapsed, stats.window/1000))
+    print_stats(stats.summary(window=True))
+    print("=== {:.1f} s: cumulative ===".format(elapsed))
+    print_stats(stats.summary())
+    print(flush=True)
+
+
+def stream_csv(f, interval, window, dumpfile=None, tag_id=None, logwriter=None,
+               report=print_running_stats, repeats="packet", rssi_filter=None):
+    ''' Parse the serial port output, reporting running statistics on the way.
+
+    Packets are not kept, so memory use does not grow with capture length.
+    They are appended to `logwriter`, a CaptureLogWriter, if given, as
+    they were received; only the statistics see the calibrated and
+    filtered RSSI.
+    '''
+    stats = StreamingStats(window=int(window*1000), repeats=repeats)
+    smoother = StreamingFilter(rssi_filter) if rssi_filter else None
+    offsets = calibration.active()
+    if dumpfile:
+        writer = csv.writer(dumpfile)
+    reader = csv.reader(f)
+    timestamp_offset = None
+    startTime = lastReport = time.time()
+    for row in reader:
+        if dumpfile:
+            writer.writerow(row)
+        if timestamp_offset == None:
+            timestamp_offset = int(row[2])
+            if logwriter:
+                logwriter.metadata["timestamp_offset"] = timestamp_offset
+        packet = (tag_id if tag_id is not None else int(row[0]), int(row[1]),
+            int(row[2]) - timestamp_offset, int(row[3]), freq_to_channel_num(int(row[4])))
+        rssi = packet[3] + offsets.offset(packet[0], packet[4]) if offsets else packet[3]
+        if smoother:
+            rssi = smoother.add(packet[0], packet[4], rssi)
+        stats.add(*packet[:3], rssi, packet[4])
+        if logwriter:
+            logwriter.append(*packet)
+        now = time.time()
+        if now - lastReport >= interval:
+            report(stats, now - startTime)
+            lastReport = now
+        if args.time != None and (now - startTime) >= args.time:
+            break
+    report(stats, time.time() - startTime)
+    return stats
 
 
 def plot_data(datapoints, stats, filename=None, disp_chart=True):
@@ -168,12 +183,11 @@ def plot_data(datapoints, stats, filename=None, disp_chart=True):
     ids = __get_ids(datapoints)
 
     # RSSI over time, separated by channel
-    for j, channel in enumerate([37, 38, 39]):
+    for j, channel in enumerate(CHANNELS):
         ax = axes[j // 3][j % 3]
         for i in ids:
-            timestamps = [dp["timestamp"]/1000 for dp in datapoints if dp["tag_id"] == i and dp["channel"] == channel]
-            rssi = [dp["rssi"] for dp in datapoints if dp["tag_id"] == i and dp["channel"] == channel]
-            ax.plot(timestamps, rssi)
+            dps = datapoints.select(tag=i, channel=channel)
+            ax.plot(dps.timestamp/1000, dps.rssi)
         ax.set_title("Signal Strength, Channel {}".format(channel))
         ax.set_xlabel("Time (seconds)")
         ax.set_ylabel("RSSI (dBm)")
@@ -184,9 +198,8 @@ def plot_data(datapoints, stats, filename=None, disp_chart=True):
     # RSSI over time, not separated
     ax = axes[1][0]
     for i in ids:
-        timestamps = [dp["timestamp"]/1000 for dp in datapoints if dp["tag_id"] == i]
-        rssi = [dp["rssi"] for dp in datapoints if dp["tag_id"] == i]
-        ax.plot(timestamps, rssi)
+        dps = datapoints.select(tag=i)
+        ax.plot(dps.timestamp/1000, dps.rssi)
     ax.set_title("Signal Strength, Channels 37-39")
     ax.set_xlabel("Time (seconds)")
     ax.set_ylabel("RSSI (dBm)")
@@ -211,19 +224,15 @@ def plot_data(datapoints, stats, filename=None, disp_chart=True):
     ax.set_xmargin(0.1)
     ax.autoscale()
 
-    # Advertisement drift over time
+    # Advertisement timing against each tag's fitted period
     ax = axes[1][2]
     for i in ids:
-        datapoints_for_tag = [dp for dp in datapoints if dp["tag_id"] == i]
-        timestamps = [dp["timestamp"]/1000 for dp in datapoints_for_tag]
-        timestamp_diffs = [0] + [curr["timestamp"] - prev["timestamp"] - \
-                100*((curr["sequence_num"] - prev["sequence_num"]) % 256) \
-                for prev, curr in zip(datapoints_for_tag, datapoints_for_tag[1:])]
-        ax.plot(timestamps, timestamp_diffs)
+        dps = datapoints.select(tag=i)
+        ax.plot(dps.timestamp/1000, stats["adv_residuals"][i])
     ax.set_title("Advertisement Jitter and Drift")
     ax.set_xlabel("Time (seconds)")
-    ax.set_ylabel("Period jitter (ms)")
-    ax.legend(ids)
+    ax.set_ylabel("Deviation from fitted period (ms)")
+    ax.legend(["{} ({:.3f} ms)".format(i, stats["adv_period"][i]) for i in ids])
     ax.margins(y=1)
     ax.autoscale(tight=True)
 
@@ -233,47 +242,121 @@ def plot_data(datapoints, stats, filename=None, disp_chart=True):
         plt.show()
 
 
-def write_log(datapoints, f):
-    ''' Write the data points to a log file. '''
-    ids = __get_ids(datapoints)
-    writer = csv.writer(f)
-    writer.writerow(["Timestamp"] + ids)
-
-    for dp in datapoints:
-        row = [dp["timestamp"]] + [None]*len(ids)
-        row[1 + ids.index(dp["tag_id"])] = dp["rssi"]
-        writer.writerow(row)
+def write_log(datapoints, f, bin_size=100, by_channel=False, fill=False, sparse=False):
+    ''' Write the data points to a log file.
+
+    One row per `bin_size` milliseconds, with every tag's (or tag and
+    channel's) mean RSSI and packet count in the bin, and empty means
+    unless filled forward. With sparse=True, one row per packet in the
+    sparse _processed.csv layout instead.
+    '''
+    if sparse:
+        write_processed(datapoints, f)
+        return
+    bins = time_bins(datapoints, bin_size, by_channel, fill)
+    names = ["{} ch{}".format(*column) if by_channel else str(column) for column in bins.columns]
+    header = ["Timestamp"]
+    columns = [bins.times]
+    for j, name in enumerate(names):
+        header += [name + " mean", name + " count"]
+        columns += [np.round(bins.mean[:, j], 3), bins.count[:, j]]
+    write_table(f, header, columns)
+
+
+def __is_serial_port(infile):
+    return os.path.dirname(infile) == "/dev" or infile.startswith("COM")
+
+
+def __capture_concurrently(ports, tag_ids):
+    ''' Read all serial ports at once, one dataset per receiver. '''
+    dumpfiles = None
+    logwriters = None
+    on_packet = None
+    on_offset = None
+    if args.outdir and args.binary:
+        logwriters = [CaptureLogWriter(os.path.join(args.outdir, "raw_{}.cap".format(receiver)),
+                {"source": port, "receiver": receiver})
+            for receiver, port in enumerate(ports, 1)]
+        def on_packet(receiver, host_time, *packet):
+            logwriters[receiver-1].append(*packet)
+        def on_offset(receiver, timestamp_offset):
+            logwriters[receiver-1].metadata["timestamp_offset"] = timestamp_offset
+    elif args.outdir:
+        dumpfiles = [open(os.path.join(args.outdir, "raw_{}.csv".format(receiver)), "w")
+            for receiver in range(1, len(ports)+1)]
+    try:
+        receptions = capture.capture(ports, args.time, args.baud_rate,
+            tag_ids=tag_ids, dumpfiles=dumpfiles, on_packet=on_packet, on_offset=on_offset)
+    finally:
+        for dumpfile in dumpfiles or []:
+            dumpfile.close()
+        for logwriter in logwriters or []:
+            logwriter.close()
+    if args.outdir:
+        with open(os.path.join(args.outdir, "merged.csv"), "w") as f:
+            capture.write_merged(*capture.merge(receptions), f)
+    for reception in receptions:
+        print("Receiver {} ({}): {} packets".format(reception.receiver,
+            reception.port, len(reception.datapoints)))
+    return [calibrated(reception.datapoints) for reception in receptions]
 
 
 def __main():
     datapoints = []
+    # Several scanners are read at the same time rather than one after another
+    ports = [infile for infile in args.infiles if __is_serial_port(infile)]
+    concurrent = len(ports) > 1 and not args.live
     for file_num, infile in enumerate(args.infiles):
         file_ext = os.path.splitext(infile)[1]
-        dir_name = os.path.dirname(infile)
         renumbered_id = file_num+1 if args.renumber else None
+        if concurrent and infile in ports:
+            continue
         if file_ext == ".psd":
             with open(infile, "rb") as f:
-                datapoints += parse_psd(f, tag_id=renumbered_id)
-        elif dir_name == "/dev" or infile.startswith("COM"):
-            if args.outdir:
+                datapoints.append(parse_psd(f, tag_id=renumbered_id))
+            continue
+        elif file_ext == ".cap":
+            datapoints.append(read_capture_log(infile, tag_id=renumbered_id)[1])
+            continue
+        elif __is_serial_port(infile):
+            dumpfile = None
+            logwriter = None
+            if args.outdir and args.binary:
+                logwriter = CaptureLogWriter(os.path.join(args.outdir, "raw.cap"), {"source": infile})
+            elif args.outdir:
                 dumpfile = open(os.path.join(args.outdir, "raw.csv"), "w")
             f = serial.Serial(infile, baudrate=args.baud_rate)
             # Remove the first few lines, which are usually garbage
             for i in range(30):
                 f.readline()
-            datapoints += parse_csv(__BinaryToText(f), dumpfile, tag_id=renumbered_id)
-            if args.outdir:
+            if args.live:
+                stream_csv(__BinaryToText(f), args.live, args.window, dumpfile,
+                    tag_id=renumbered_id, logwriter=logwriter, repeats=args.repeats,
+                    rssi_filter=make_filters(args.filter))
+            else:
+                datapoints.append(parse_csv(__BinaryToText(f), dumpfile,
+                    tag_id=renumbered_id, logwriter=logwriter))
+            if dumpfile:
                 dumpfile.close()
+            if logwriter:
+                logwriter.close()
+            continue
         elif os.path.isdir(infile):
             infile += "/raw.csv"
         with open(infile, "r") as f:
-            datapoints += parse_csv(f, tag_id=renumbered_id)
+            datapoints.append(read_csv(f, tag_id=renumbered_id))
+    if concurrent:
+        datapoints += __capture_concurrently(ports, [args.infiles.index(port)+1
+            for port in ports] if args.renumber else None)
+    if not datapoints:
+        return
+    datapoints = DataPoints.concat(datapoints)
 
     if args.outdir:
         with open(os.path.join(args.outdir, "log.csv"), "w") as f:
-            write_log(datapoints, f)
+            write_log(datapoints, f, args.bin, args.by_channel, args.fill, args.sparse_log)
 
-    stats = calculate_stats(datapoints)
+    stats = calculate_stats(datapoints, args.repeats, make_filters(args.filter))
     # for tag in __get_ids(datapoints):
     #     print("Tag {}:".format(tag))
     #     print("  Loss: {:.3}%".format(float(stats["loss_rate"][tag])))
@@ -292,7 +375,8 @@ def __main():
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("infiles",
-        help="data file(s) or serial port to analyze",
+        help="data file(s) or serial port(s) to analyze; several serial "
+             "ports are read concurrently",
         nargs="+")
     arg_parser.add_argument("-o", "--outdir",
         help="directory to write output files")
@@ -308,6 +392,37 @@ if __name__ == "__main__":
     arg_parser.add_argument("-r", "--renumber",
         help="renumber tag IDs starting from 1",
         action="store_true")
+    arg_parser.add_argument("-l", "--live",
+        help="print running statistics every LIVE seconds while reading "
+             "a serial port, without keeping the packets",
+        type=float)
+    arg_parser.add_argument("-B", "--binary",
+        help="save serial captures as binary capture logs (raw.cap) "
+             "instead of raw.csv",
+        action="store_true")
+    arg_parser.add_argument("-w", "--window",
+        help="length in seconds of the sliding window for --live (default: 10)",
+        type=float, default=10)
+    arg_parser.add_argument("--repeats",
+        help="count a repeated sequence number as another packet, or as the "
+             "same advertising event heard again (default: packet)",
+        choices=LossCounter.REPEATS, default="packet")
+    arg_parser.add_argument("-F", "--filter",
+        help="filters to run each tag and channel's RSSI through, in order, "
+             "before taking statistics",
+        nargs="+", choices=list(FILTERS), default=[])
+    arg_parser.add_argument("--bin",
+        help="milliseconds per row of the log written with -o (default: 100)",
+        type=int, default=100)
+    arg_parser.add_argument("--by-channel",
+        help="split the log's columns by channel as well as by tag",
+        action="store_true")
+    arg_parser.add_argument("--fill",
+        help="fill bins of the log with no packets with the tag's last mean",
+        action="store_true")
+    arg_parser.add_argument("--sparse-log",
+        help="write the log one row per packet, in the _processed.csv layout",
+        action="store_true")
     args = arg_parser.parse_args()
 
     if args.outdir != None:
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+''' Per-tag, per-channel RSSI calibration.
+
+Tags differ in how strongly they transmit and receivers hear them, so
+the same position reads differently from one tag to the next. Every tag
+under Orientation/Calibration was captured at the same radii and
+orientations; at each of those, a tag's mean RSSI on a channel less the
+mean over every tag there is its difference from the average tag. A
+tag's offset is the mean of those differences over every position,
+negated, so that adding it brings the tag's RSSI in line with the
+others.
+
+The table of offsets in use is read from $MOBIUS_CALIBRATION (default:
+calibration.csv under Orientation/Calibration), if it exists. Setting
+it to an empty string disables calibration. The parsers (read_csv,
+load_csv, read_capture_log and those of analyze.py) add each packet's
+offset as they load a capture; as RSSI is kept in whole dBm, offsets are
+rounded to the nearest dBm. Tags and channels not in the table are left
+as they are. Captures and caches on disk keep the RSSI as received.
+
+Run as a script, it builds the table from the calibration captures and
+writes it to the path in use.
+'''
+
+import argparse
+import csv
+import hashlib
+import io
+import os
+import warnings
+import numpy as np
+
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "Orientation", "Calibration", "calibration.csv")
+
+
+def calibration_path():
+    return os.environ.get("MOBIUS_CALIBRATION", DEFAULT_PATH)
+
+
+class Calibration:
+    ''' RSSI offsets (dBm) by (tag, channel). '''
+    def __init__(self, offsets=None):
+        self.offsets = dict(offsets or {})
+        self.checksum = ""
+        self.__lookup = None
+
+    def __table(self):
+        ''' Whole-dBm offsets indexed [tag, channel], with tags past the end having none. '''
+        if self.__lookup is None:
+            size = max([tag for tag, _ in self.offsets] + [-1]) + 1
+            table = np.zeros((size, 256), dtype=np.int64)
+            for (tag, channel), offset in self.offsets.items():
+                table[tag, channel] = int(np.round(offset))
+            self.__lookup = table
+        return self.__lookup
+
+    def apply(self, tag_id, channel, rssi):
+        ''' RSSI with every packet's offset added, by one lookup per array. '''
+        table = self.__table()
+        tag_id = np.asarray(tag_id, dtype=np.int64)
+        known = (tag_id >= 0) & (tag_id < len(table))
+        offsets = table[np.where(known, tag_id, 0), np.asarray(channel, dtype=np.int64)]
+        return np.clip(np.asarray(rssi, dtype=np.int64) + np.where(known, offsets, 0), -128, 127)
+
+    def offset(self, tag_id, channel):
+        ''' Whole-dBm offset of one packet, for readers that take packets one at a time. '''
+        table = self.__table()
+        return int(table[tag_id, channel]) if 0 <= tag_id < len(table) else 0
+
+    def save(self, f):
+        ''' Write the table as CSV. '''
+        writer = csv.writer(f)
+        writer.writerow(["tag", "channel", "offset"])
+        for (tag, channel), offset in sorted(self.offsets.items()):
+            writer.writerow([tag, channel, round(offset, 3)])
+
+    @classmethod
+    def load(cls, f):
+        calibration = cls()
+        reader = csv.reader(f)
+        next(reader)
+        for tag, channel, offset in reader:
+            calibration.offsets[(int(tag), int(channel))] = float(offset)
+        return calibration
+
+
+__active = {}
+
+
+def active():
+    ''' The calibration in use, or None, reread whenever its file changes. '''
+    path = calibration_path()
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key not in __active:
+        with open(path, "rb") as f:
+            data = f.read()
+        calibration = Calibration.load(io.StringIO(data.decode("utf-8")))
+        calibration.checksum = hashlib.blake2b(data, digest_size=16).hexdigest()
+        __active.clear()
+        __active[key] = calibration
+    return __active[key]
+
+
+def checksum():
+    ''' Hash of the calibration in use, or "" if there is none. '''
+    calibration = active()
+    return calibration.checksum if calibration else ""
+
+
+def calibrate(tag_id, channel, rssi):
+    ''' RSSI calibrated with the table in use, if any. '''
+    calibration = active()
+    if calibration is None:
+        return np.asarray(rssi, dtype=np.int64)
+    return calibration.apply(tag_id, channel, rssi)
+
+
+def build(root, channels=None, workers=None):
+    ''' Derive the offsets from the captures under root, as received. '''
+    # Imported here, as the parsers these need import this module
+    from aggregate import group_stats
+    from dataset import load_dataset
+    from datapoints import CHANNELS
+    channels = list(CHANNELS if channels is None else channels)
+
+    means = {}
+    for capture, datapoints in load_dataset(root, workers, calibrate=False).items():
+        stats = group_stats(datapoints, channels)
+        for tag, mean in zip(stats.ids, stats.mean):
+            means[(tag, capture.radius, capture.angle)] = mean
+    tags = sorted(set(tag for tag, _, _ in means))
+    positions = sorted(set(key[1:] for key in means))
+    # Mean RSSI indexed [tag, position, channel], and its difference from the average tag
+    table = np.array([[means.get((tag,) + position, np.full(len(channels), np.nan))
+        for position in positions] for tag in tags]).reshape(len(tags), len(positions), len(channels))
+    with warnings.catch_warnings():
+        # Positions and channels no tag was heard at have NaN means
+        warnings.simplefilter("ignore", RuntimeWarning)
+        differences = table - np.nanmean(table, axis=0)
+
+        calibration = Calibration()
+        offsets = -np.nanmean(differences, axis=1)
+        for i, tag in enumerate(tags):
+            for j, channel in enumerate(channels):
+                if not np.isnan(offsets[i, j]):
+                    calibration.offsets[(tag, channel)] = float(offsets[i, j])
+    return calibration
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    arg_parser = argparse.ArgumentParser(
+        description="build the per-tag, per-channel RSSI calibration table")
+    arg_parser.add_argument("root",
+        help="directory of the calibration captures (default: Orientation/Calibration)",
+        nargs="?",
+        default=os.path.join(here, "Orientation", "Calibration"))
+    arg_parser.add_argument("-o", "--outfile",
+        help="file to write the table to (default: $MOBIUS_CALIBRATION, or {})".format(
+            os.path.relpath(DEFAULT_PATH, here)))
+    arg_parser.add_argument("-j", "--jobs",
+        help="number of processes (default: one per core)",
+        type=int)
+    args = arg_parser.parse_args()
+    outfile = args.outfile or calibration_path()
+    if not outfile:
+        arg_parser.error("calibration is disabled; give an output file with -o")
+
+    calibration = build(args.root, workers=args.jobs)
+    tmp = "{}.{}.tmp".format(outfile, os.getpid())
+    with open(tmp, "w") as f:
+        calibration.save(f)
+    os.replace(tmp, outfile)
+    for (tag, channel), offset in sorted(calibration.offsets.items()):
+        print("Tag {}, channel {}: {:+.2f} dBm".format(tag, channel, offset))
+    print("Wrote {}".format(outfile))
@@ -0,0 +1,164 @@
+import array
+import csv
+import threading
+import time
+import numpy as np
+import serial
+from datapoints import DataPoints, freq_to_channel_num
+
+
+class Reception:
+    ''' Packets captured by one receiver.
+
+    `host_time` holds the host clock (seconds since the epoch) at which
+    each packet in `datapoints` was read from the port. Timestamps are
+    relative to the first packet's, `timestamp_offset` (None if there
+    were no packets).
+    '''
+    def __init__(self, receiver, port, datapoints, host_time, timestamp_offset=None):
+        self.receiver = receiver
+        self.port = port
+        self.datapoints = datapoints
+        self.host_time = host_time
+        self.timestamp_offset = timestamp_offset
+
+
+class PortReader(threading.Thread):
+    ''' Reads one scanner's serial output on its own thread.
+
+    Packets' timestamps are made relative to the first one's, which is
+    kept as `timestamp_offset` and passed to `on_offset(receiver, offset)`
+    before the first packet reaches `on_packet`.
+    '''
+    def __init__(self, port, receiver, deadline, stop, baud_rate=115200,
+                 tag_id=None, dumpfile=None, on_packet=None, skip_lines=30, keep=True,
+                 on_offset=None):
+        super().__init__(name="capture {}".format(port), daemon=True)
+        self.port = port
+        self.receiver = receiver
+        self.deadline = deadline
+        self.stop = stop
+        self.baud_rate = baud_rate
+        self.tag_id = tag_id
+        self.dumpfile = dumpfile
+        self.on_packet = on_packet
+        self.on_offset = on_offset
+        self.skip_lines = skip_lines
+        # Long-running readers pass packets on without keeping them
+        self.keep = keep
+        self.columns = dict((key, array.array("q")) for key in DataPoints.COLUMNS)
+        self.host_time = array.array("d")
+        self.timestamp_offset = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.__read()
+        except Exception as e:
+            self.error = e
+
+    def __lines(self):
+        ''' Yield (host time, line) until the deadline passes or capture stops. '''
+        # A short timeout lets the thread notice the deadline on a quiet port
+        with serial.Serial(self.port, baudrate=self.baud_rate, timeout=0.1) as f:
+            partial = b""
+            while not self.stop.is_set() and time.time() < self.deadline:
+                partial += f.readline()
+                if not partial.endswith(b"\n"):
+                    continue
+                line, partial = partial, b""
+                yield time.time(), line.decode("ascii", errors="replace").strip()
+
+    def __read(self):
+        writer = csv.writer(self.dumpfile) if self.dumpfile else None
+        for line_num, (host_time, line) in enumerate(self.__lines()):
+            # Remove the first few lines, which are usually garbage
+            if line_num < self.skip_lines:
+                continue
+            row = line.split(",")
+            try:
+                tag_id, sequence_num, timestamp, rssi, freq = [int(i) for i in row[:5]]
+            except ValueError:
+                continue
+            if writer:
+                writer.writerow(row)
+            if self.tag_id is not None:
+                tag_id = self.tag_id
+            if self.timestamp_offset == None:
+                self.timestamp_offset = timestamp
+                if self.on_offset:
+                    self.on_offset(self.receiver, timestamp)
+            timestamp -= self.timestamp_offset
+            channel = freq_to_channel_num(freq)
+            if self.keep:
+                self.columns["tag_id"].append(tag_id)
+                self.columns["sequence_num"].append(sequence_num)
+                self.columns["timestamp"].append(timestamp)
+                self.columns["rssi"].append(rssi)
+                self.columns["channel"].append(channel)
+                self.host_time.append(host_time)
+            if self.on_packet:
+                self.on_packet(self.receiver, host_time, tag_id, sequence_num,
+                    timestamp, rssi, channel)
+
+    def reception(self):
+        return Reception(self.receiver, self.port, DataPoints(**self.columns),
+            np.frombuffer(self.host_time, dtype=np.float64).copy(), self.timestamp_offset)
+
+
+def capture(ports, duration=None, baud_rate=115200, tag_ids=None, dumpfiles=None, on_packet=None,
+            on_offset=None):
+    ''' Read several serial ports at once until a shared deadline.
+
+    Receivers are numbered from 1 in the order of `ports`. Runs until
+    `duration` seconds have passed, or until interrupted if it is None.
+    `on_packet` is called from the reader threads for every packet, and
+    `on_offset` for each receiver's timestamp offset (see PortReader).
+    Returns one Reception per port.
+    '''
+    stop = threading.Event()
+    deadline = time.time() + duration if duration is not None else float("inf")
+    readers = [PortReader(port, receiver, deadline, stop, baud_rate,
+            tag_id=tag_ids[receiver-1] if tag_ids else None,
+            dumpfile=dumpfiles[receiver-1] if dumpfiles else None,
+            on_packet=on_packet, on_offset=on_offset)
+        for receiver, port in enumerate(ports, 1)]
+    for reader in readers:
+        reader.start()
+    try:
+        for reader in readers:
+            while reader.is_alive():
+                reader.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for reader in readers:
+            reader.join()
+    for reader in readers:
+        if reader.error:
+            raise reader.error
+    return [reader.reception() for reader in readers]
+
+
+def merge(receptions):
+    ''' Merge receptions into one stream ordered by host receive time.
+
+    Returns the receiver of each packet, its host time and the packets.
+    '''
+    if not receptions:
+        return np.empty(0, dtype=np.int64), np.empty(0), DataPoints()
+    receiver = np.concatenate([np.full(len(r.datapoints), r.receiver, dtype=np.int64)
+        for r in receptions])
+    host_time = np.concatenate([r.host_time for r in receptions])
+    order = np.argsort(host_time, kind="stable")
+    datapoints = DataPoints.concat([r.datapoints for r in receptions]).take(order)
+    return receiver[order], host_time[order], datapoints
+
+
+def write_merged(receiver, host_time, datapoints, f):
+    ''' Write a merged stream as CSV with its receiver and host time columns. '''
+    writer = csv.writer(f)
+    writer.writerow(["receiver", "host_time"] + DataPoints.COLUMNS)
+    writer.writerows(zip(receiver.tolist(), ["{:.6f}".format(t) for t in host_time.tolist()],
+        datapoints.tag_id.tolist(), datapoints.sequence_num.tolist(),
+        datapoints.timestamp.tolist(), datapoints.rssi.tolist(),
+        datapoints.channel.tolist()))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+''' Compact binary capture logs.
+
+A capture log (.cap) is a small header followed by fixed-width packet
+records, and is only ever appended to. The header is the magic bytes,
+the length of a JSON metadata block and the block itself, padded to a
+multiple of 8 bytes. Timestamps are stored relative to the capture
+start; the absolute offset is kept in the metadata.
+
+Every INDEX_EVERY records the writer appends (record number, timestamp)
+to a sidecar .idx file. Reading a time range searches this sparse index
+before touching the records.
+'''
+
+import argparse
+import csv
+import json
+import os
+import struct
+import time
+import numpy as np
+import calibration
+from datapoints import DataPoints, read_csv_columns, write_processed
+
+
+MAGIC = b"MOBICAP1"
+RECORD = np.dtype([
+    ("timestamp", "<i8"),
+    ("tag_id", "<u2"),
+    ("sequence_num", "u1"),
+    ("rssi", "i1"),
+    ("channel", "u1"),
+])
+INDEX_ENTRY = np.dtype([("record", "<i8"), ("timestamp", "<i8")])
+INDEX_EVERY = 4096
+# Inverse of freq_to_channel_num
+CHANNEL_TO_FREQ = {37: 2, 38: 26, 39: 80}
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + ".idx"
+
+
+def read_header(f):
+    ''' Read the metadata and return it with the offset of the first record. '''
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a capture log")
+    length, = struct.unpack("<I", f.read(4))
+    metadata = json.loads(f.read(length).decode("utf-8"))
+    return metadata, f.tell() + (-f.tell() % 8)
+
+
+def write_header(f, metadata):
+    ''' Write the magic bytes and metadata block, padded to 8 bytes. '''
+    block = json.dumps(metadata, sort_keys=True).encode("utf-8")
+    header = MAGIC + struct.pack("<I", len(block)) + block
+    f.write(header + b" " * (-len(header) % 8))
+
+
+class CaptureLogWriter:
+    ''' Appends packets to a capture log.
+
+    Opening an existing log continues it; its metadata is kept. For a new
+    log the header is only written with the first records, so `metadata`
+    (e.g. the timestamp offset) may still be filled in until then. Records
+    are buffered and written out every `buffer_size` packets, on flush()
+    and on close().
+    '''
+    def __init__(self, path, metadata=None, buffer_size=1024):
+        self.path = path
+        self.buffer = np.empty(buffer_size, dtype=RECORD)
+        self.buffered = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                self.metadata, header_size = read_header(f)
+            self.f = open(path, "ab")
+            self.count = (os.path.getsize(path) - header_size) // RECORD.itemsize
+        else:
+            self.metadata = dict(metadata or {})
+            self.metadata.setdefault("created", time.time())
+            self.metadata.setdefault("timestamp_offset", 0)
+            self.f = open(path, "wb")
+            self.count = 0
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+        self.index = open(index_path(path), "ab")
+
+    def append(self, tag_id, sequence_num, timestamp, rssi, channel):
+        ''' Append one packet. '''
+        self.buffer[self.buffered] = (timestamp, tag_id, sequence_num, rssi, channel)
+        self.buffered += 1
+        if self.buffered == len(self.buffer):
+            self.flush()
+
+    def extend(self, datapoints):
+        ''' Append a whole DataPoints table. '''
+        self.flush()
+        records = np.empty(len(datapoints), dtype=RECORD)
+        for key in RECORD.names:
+            records[key] = getattr(datapoints, key)
+        self.__write(records)
+
+    def flush(self):
+        if self.f.tell() == 0:
+            write_header(self.f, self.metadata)
+        if self.buffered:
+            self.__write(self.buffer[:self.buffered])
+            self.buffered = 0
+        self.f.flush()
+        self.index.flush()
+
+    def __write(self, records):
+        if self.f.tell() == 0:
+            write_header(self.f, self.metadata)
+        # Index every record whose number is a multiple of INDEX_EVERY
+        numbers = np.arange(self.count, self.count + len(records))
+        indexed = numbers % INDEX_EVERY == 0
+        entries = np.empty(np.count_nonzero(indexed), dtype=INDEX_ENTRY)
+        entries["record"] = numbers[indexed]
+        entries["timestamp"] = records["timestamp"][indexed]
+        self.f.write(records.tobytes())
+        self.index.write(entries.tobytes())
+        self.count += len(records)
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def __record_range(path, count, start, end):
+    ''' Narrow [0, count) down to the records that may lie in [start, end). '''
+    lo, hi = 0, count
+    if (start is None and end is None) or not os.path.exists(index_path(path)):
+        return lo, hi
+    index = np.fromfile(index_path(path), dtype=INDEX_ENTRY)
+    if start is not None:
+        i = np.searchsorted(index["timestamp"], start, side="left")
+        lo = int(index["record"][i-1]) if i > 0 else 0
+    if end is not None:
+        i = np.searchsorted(index["timestamp"], end, side="left")
+        hi = int(index["record"][i]) if i < len(index) else count
+    return lo, min(hi, count)
+
+
+def read_capture_log(path, start=None, end=None, tag_id=None, calibrate=True):
+    ''' Memory-map a capture log into its metadata and a DataPoints table.
+
+    With `start` and/or `end` (milliseconds, relative to the capture
+    start), only packets with start <= timestamp < end are returned. The
+    RSSI is calibrated as read_csv calibrates it.
+    '''
+    with open(path, "rb") as f:
+        metadata, header_size = read_header(f)
+    count = (os.path.getsize(path) - header_size) // RECORD.itemsize
+    if count == 0:
+        return metadata, DataPoints()
+    records = np.memmap(path, dtype=RECORD, mode="r", offset=header_size, shape=(count,))
+    lo, hi = __record_range(path, count, start, end)
+    records = records[lo:hi]
+    if start is not None or end is not None:
+        timestamp = records["timestamp"]
+        mask = np.ones(len(records), dtype=bool)
+        if start is not None:
+            mask &= timestamp >= start
+        if end is not None:
+            mask &= timestamp < end
+        records = records[mask]
+    columns = dict((key, records[key]) for key in DataPoints.COLUMNS)
+    if tag_id is not None:
+        columns["tag_id"] = np.full(len(records), tag_id)
+    if calibrate:
+        columns["rssi"] = calibration.calibrate(columns["tag_id"], columns["channel"], columns["rssi"])
+    return metadata, DataPoints(**columns)
+
+
+def csv_to_log(csv_file, path, metadata=None):
+    ''' Convert a raw CSV capture (4 or 5 columns) into a capture log. '''
+    columns, _, _ = read_csv_columns(csv_file)
+    del columns["segment"]
+    offset = int(columns["timestamp"][0]) if len(columns["timestamp"]) else 0
+    columns["timestamp"] = columns["timestamp"] - offset
+    metadata = dict(metadata or {}, timestamp_offset=offset)
+    with CaptureLogWriter(path, metadata) as writer:
+        writer.extend(DataPoints(**columns))
+
+
+def processed_to_log(csv_file, path, metadata=None):
+    ''' Convert a _processed.csv (or analyze.py --sparse-log log.csv) file into a capture log.
+
+    That layout has no sequence numbers or channels, so both are stored
+    as 0.
+    '''
+    reader = csv.reader(csv_file)
+    ids = [int(i) for i in next(reader)[1:]]
+    columns = dict((key, []) for key in DataPoints.COLUMNS)
+    for row in reader:
+        for tag_id, rssi in zip(ids, row[1:]):
+            if rssi != "":
+                columns["tag_id"].append(tag_id)
+                columns["timestamp"].append(int(row[0]))
+                columns["rssi"].append(int(rssi))
+    columns["sequence_num"] = [0] * len(columns["tag_id"])
+    columns["channel"] = [0] * len(columns["tag_id"])
+    with CaptureLogWriter(path, metadata) as writer:
+        writer.extend(DataPoints(**columns))
+
+
+def log_to_csv(path, csv_file):
+    ''' Convert a capture log back into the raw 5-column CSV layout. '''
+    metadata, datapoints = read_capture_log(path, calibrate=False)
+    freq = np.zeros(256, dtype=np.int64)
+    for ch, f in CHANNEL_TO_FREQ.items():
+        freq[ch] = f
+    csv.writer(csv_file, lineterminator="\n").writerows(zip(datapoints.tag_id.tolist(),
+        datapoints.sequence_num.tolist(),
+        (datapoints.timestamp + metadata.get("timestamp_offset", 0)).tolist(),
+        datapoints.rssi.tolist(), freq[datapoints.channel].tolist()))
+
+
+def log_to_processed(path, csv_file):
+    ''' Convert a capture log into the sparse _processed.csv layout. '''
+    _, datapoints = read_capture_log(path, calibrate=False)
+    write_processed(datapoints, csv_file)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="convert between CSV captures and binary capture logs (.cap)")
+    arg_parser.add_argument("infile",
+        help="capture to convert")
+    arg_parser.add_argument("outfile",
+        help="file to write; a .cap file if infile is a CSV file, and vice versa")
+    arg_parser.add_argument("-p", "--processed",
+        help="the CSV file uses the _processed.csv layout",
+        action="store_true")
+    args = arg_parser.parse_args()
+
+    if os.path.splitext(args.infile)[1] == ".cap":
+        with open(args.outfile, "w", newline="") as f:
+            (log_to_processed if args.processed else log_to_csv)(args.infile, f)
+    else:
+        with open(args.infile, "r") as f:
+            (processed_to_log if args.processed else csv_to_log)(
+                f, args.outfile, {"source": os.path.abspath(args.infile)})
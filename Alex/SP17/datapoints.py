@@ -0,0 +1,336 @@
+import csv
+import mmap
+import os
+import re
+import warnings
+import numpy as np
+import calibration
+
+
+CHANNELS = [37, 38, 39]
+# Channel number of every frequency (24xx MHz) that fits in a byte
+FREQ_TO_CHANNEL = np.zeros(256, dtype=np.uint8)
+FREQ_TO_CHANNEL[[2, 26, 80]] = [37, 38, 39]
+
+# Character classes of the bulk CSV parser
+INVALID, SPACE, DIGIT, SIGN, COMMA, NEWLINE = range(6)
+CSV_CHAR_KIND = np.full(256, INVALID, dtype=np.uint8)
+CSV_CHAR_KIND[[ord(c) for c in " \t\r"]] = SPACE
+CSV_CHAR_KIND[ord("0"):ord("9")+1] = DIGIT
+CSV_CHAR_KIND[[ord("-"), ord("+")]] = SIGN
+CSV_CHAR_KIND[ord(",")] = COMMA
+CSV_CHAR_KIND[ord("\n")] = NEWLINE
+
+# FA16 scan interval markers, e.g. "--,1,10.0,--"
+CSV_MARKER = re.compile(r"^--,(.*?)\s*$", re.M)
+# Lines that are neither a 4- or 5-column packet row nor blank
+CSV_MALFORMED = re.compile(
+    r"^(?![ \t]*(?:[-+]?\d+[ \t]*,[ \t]*){3}[-+]?\d+[ \t]*(?:,[ \t]*[-+]?\d+[ \t]*)?\r?$|\s*$).*\n?",
+    re.M)
+
+
+def freq_to_channel_num(freq):
+    ''' Map frequency (24xx MHz) to advertising channel number. '''
+    if freq == 2:
+        return 37
+    elif freq == 26:
+        return 38
+    elif freq == 80:
+        return 39
+    else:
+        return 0
+
+
+class DataPoints:
+    ''' Columnar table of received packets.
+
+    Each column is a NumPy array with one entry per packet. Tag IDs are
+    interned: `ids` holds the sorted distinct tag IDs and `tag_index` the
+    dense index of each packet's tag into it. A channel of 0 means the
+    channel is unknown.
+    '''
+    COLUMNS = ["tag_id", "sequence_num", "timestamp", "rssi", "channel"]
+
+    def __init__(self, tag_id=(), sequence_num=(), timestamp=(), rssi=(), channel=None):
+        tag_id = np.asarray(tag_id, dtype=np.int64)
+        ids, tag_index = np.unique(tag_id, return_inverse=True)
+        if channel is None:
+            channel = np.zeros(len(tag_id), dtype=np.uint8)
+        self._set(ids, tag_index.reshape(-1),
+            np.asarray(sequence_num, dtype=np.int64).astype(np.uint8),
+            np.asarray(timestamp, dtype=np.int64),
+            np.asarray(rssi, dtype=np.int64).astype(np.int8),
+            np.asarray(channel, dtype=np.int64).astype(np.uint8))
+
+    def _set(self, ids, tag_index, sequence_num, timestamp, rssi, channel):
+        n = len(tag_index)
+        if not (len(sequence_num) == len(timestamp) == len(rssi) == len(channel) == n):
+            raise ValueError("all columns must have the same length")
+        self.ids = ids
+        self.tag_index = tag_index.astype(np.uint16)
+        self.sequence_num = sequence_num
+        self.timestamp = timestamp
+        self.rssi = rssi
+        self.channel = channel
+        self._order = None
+        self._keys = None
+
+    @classmethod
+    def _from_columns(cls, ids, tag_index, sequence_num, timestamp, rssi, channel):
+        ''' Build a table from already interned columns, dropping unused IDs. '''
+        dps = cls.__new__(cls)
+        present = np.bincount(tag_index, minlength=len(ids)) > 0
+        if not present.all():
+            remap = np.cumsum(present) - 1
+            ids = ids[present]
+            tag_index = remap[tag_index]
+        dps._set(ids, tag_index, sequence_num, timestamp, rssi, channel)
+        return dps
+
+    @classmethod
+    def concat(cls, tables):
+        ''' Join several tables, re-interning their tag IDs. '''
+        tables = list(tables)
+        if not tables:
+            return cls()
+        ids = np.unique(np.concatenate([t.ids for t in tables]))
+        tag_index = np.concatenate([
+            np.searchsorted(ids, t.ids)[t.tag_index] for t in tables])
+        return cls._from_columns(ids, tag_index,
+            *[np.concatenate([getattr(t, key) for t in tables])
+                for key in cls.COLUMNS[1:]])
+
+    def __len__(self):
+        return len(self.tag_index)
+
+    @property
+    def tag_id(self):
+        return self.ids[self.tag_index]
+
+    def get_ids(self):
+        ''' Get a list of tag IDs that were detected. '''
+        return self.ids.tolist()
+
+    def take(self, indices):
+        ''' Get the packets at the given indices or boolean mask. '''
+        return self._from_columns(self.ids, self.tag_index[indices],
+            *[getattr(self, key)[indices] for key in self.COLUMNS[1:]])
+
+    def __group_order(self):
+        ''' Order of packets grouped by (tag, channel), stable in time. '''
+        if self._order is None:
+            keys = self.tag_index.astype(np.int64) * 256 + self.channel
+            self._order = np.argsort(keys, kind="stable")
+            self._keys = keys[self._order]
+        return self._order, self._keys
+
+    def select(self, tag=None, channel=None):
+        ''' Get the packets from one tag and/or on one channel. '''
+        if tag is None:
+            if channel is None:
+                return self
+            return self.take(np.flatnonzero(self.channel == channel))
+        i = np.searchsorted(self.ids, tag)
+        if i == len(self.ids) or self.ids[i] != tag:
+            return self.take(np.empty(0, dtype=np.intp))
+        order, keys = self.__group_order()
+        if channel is None:
+            # Merge the tag's per-channel runs back into time order
+            lo, hi = np.searchsorted(keys, [i * 256, i * 256 + 256])
+            return self.take(np.sort(order[lo:hi]))
+        lo, hi = np.searchsorted(keys, [i * 256 + channel, i * 256 + channel + 1])
+        return self.take(order[lo:hi])
+
+
+def __parse_rows(text):
+    ''' Parse 4- or 5-column rows into an (n, 5) array in bulk.
+
+    Rows without a frequency get -1 in its place. Raises ValueError if
+    any row is malformed.
+    '''
+    buf = np.frombuffer(text.encode("ascii", errors="replace"), dtype=np.uint8)
+    kind = CSV_CHAR_KIND[buf]
+    # Drop whitespace within rows, blank lines and newlines at either end
+    newline = kind == NEWLINE
+    keep = (kind != SPACE) & ~(newline & np.concatenate([[True], newline[:-1]]))
+    if not keep.all():
+        buf, kind = buf[keep], kind[keep]
+        newline = kind == NEWLINE
+    if len(buf) and newline[-1]:
+        buf, kind, newline = buf[:-1], kind[:-1], newline[:-1]
+    if not len(buf):
+        return np.empty((0, 5), dtype=np.int64)
+
+    # Every field must be an optional sign followed by digits
+    field_start = np.concatenate([[True], kind[:-1] >= COMMA])
+    next_digit = np.concatenate([kind[1:] == DIGIT, [False]])
+    if (kind == INVALID).any() or kind[-1] == COMMA or \
+            (field_start & ((kind >= COMMA) | ((kind == SIGN) & ~next_digit))).any() or \
+            ((kind == SIGN) & ~field_start).any():
+        raise ValueError("malformed row")
+    commas = np.searchsorted(np.flatnonzero(kind == COMMA),
+        np.append(np.flatnonzero(newline), len(buf)))
+    width = np.diff(commas, prepend=0) + 1
+    if ((width != 4) & (width != 5)).any():
+        raise ValueError("malformed row")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(np.where(newline, ord(","), buf).astype(np.uint8).tobytes(),
+            dtype=np.int64, sep=",")
+    if (width == 5).all():
+        return values.reshape(-1, 5)
+    table = np.full((len(width), 5), -1, dtype=np.int64)
+    starts = np.cumsum(width) - width
+    for col in range(5):
+        has = width > col
+        table[has, col] = values[starts[has] + col]
+    return table
+
+
+def read_csv_columns(f):
+    ''' Bulk-parse a 4-column (FA16) or 5-column (SP17) CSV capture.
+
+    Returns (columns, markers, skipped). `columns` maps each of
+    DataPoints.COLUMNS, with absolute timestamps, and "segment" to an int64
+    array. A packet's segment counts the FA16 scan interval marker rows
+    before it, whose remaining fields are listed in `markers`. Malformed
+    lines are skipped and counted in `skipped`; blank lines are ignored.
+    '''
+    text = f.read()
+    if isinstance(text, bytes):
+        text = text.decode("ascii", errors="replace")
+    chunks = CSV_MARKER.split(text) if "--" in text else [text]
+    markers = [marker.split(",") for marker in chunks[1::2]]
+    tables = []
+    skipped = 0
+    for chunk in chunks[::2]:
+        try:
+            table = __parse_rows(chunk)
+        except ValueError:
+            # Slow path: drop the malformed lines, then parse the rest
+            skipped += len(CSV_MALFORMED.findall(chunk))
+            table = __parse_rows(CSV_MALFORMED.sub("", chunk))
+        tables.append(table)
+    table = np.concatenate(tables)
+    freq = table[:, 4]
+    columns = {
+        "tag_id": table[:, 0],
+        "sequence_num": table[:, 1],
+        "timestamp": table[:, 2],
+        "rssi": table[:, 3],
+        "channel": np.where((freq >= 0) & (freq < 256),
+            FREQ_TO_CHANNEL[np.clip(freq, 0, 255)], 0),
+        "segment": np.repeat(np.arange(len(tables)), [len(t) for t in tables]),
+    }
+    return columns, markers, skipped
+
+
+def read_csv(f, tag_id=None, calibrate=True):
+    ''' Parse a CSV-formatted capture into a DataPoints table.
+
+    The RSSI is calibrated with the table in use (see calibration.py)
+    unless calibrate is False.
+    '''
+    columns, _, skipped = read_csv_columns(f)
+    if skipped:
+        warnings.warn("skipped {} malformed lines".format(skipped))
+    del columns["segment"]
+    if len(columns["timestamp"]):
+        columns["timestamp"] = columns["timestamp"] - columns["timestamp"][0]
+    if tag_id is not None:
+        columns["tag_id"] = np.full(len(columns["timestamp"]), tag_id)
+    if calibrate:
+        columns["rssi"] = calibration.calibrate(columns["tag_id"], columns["channel"], columns["rssi"])
+    return DataPoints(**columns)
+
+
+# Layout of one fixed-size record in a TI sniffer save file
+PSD_RECORD = np.dtype([
+    ("info", "u1"),
+    ("num", "<u4"),
+    ("timestamp", "<u8"),
+    ("length", "<u2"),
+    ("ble_length", "u1"),
+    ("ble_access_addr", "u1", 4),
+    ("ble_header", "<u2"),
+    ("ble_adv_addr", "u1", 6),
+    ("ble_payload", "u1", 243),
+])
+
+
+def read_psd(f, tag_id=None):
+    ''' Decode the TI sniffer save file into column arrays. '''
+    columns = {
+        "tag_id": np.empty(0, dtype=np.int64),
+        "sequence_num": np.empty(0, dtype=np.int64),
+        "timestamp": np.empty(0, dtype=np.int64),
+        "rssi": np.empty(0, dtype=np.int64),
+    }
+    if os.fstat(f.fileno()).st_size < PSD_RECORD.itemsize:
+        return columns
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        records = np.frombuffer(mm, dtype=PSD_RECORD,
+            count=len(mm) // PSD_RECORD.itemsize)
+
+        # Skip nonstandard packets, and packets too short to hold a
+        # sequence number or too long to hold the trailing RSSI byte
+        ble_length = records["ble_length"].astype(np.int64)
+        mask = (records["info"] == 1) & (ble_length >= 20) & \
+            (ble_length - 14 < PSD_RECORD["ble_payload"].shape[0])
+        ble_length = ble_length[mask]
+        timestamp = records["timestamp"][mask]
+        payload = records["ble_payload"][mask]
+
+        # Convert the data
+        # Timestamp conversion from TI document # SWRU187G, page 23
+        timeLo = timestamp & 0xFFFF
+        timeHi = timestamp >> 16
+        columns["timestamp"] = ((timeHi * 5000 + timeLo) // 32000).astype(np.int64)
+        columns["sequence_num"] = payload[:, 2].astype(np.int64)
+        # The RSSI byte follows the payload and 3-byte CRC
+        rssi = payload[np.arange(len(payload)), ble_length - 14]
+        columns["rssi"] = rssi.astype(np.int64) - 94 # Conversion determined empirically
+        if tag_id is not None:
+            columns["tag_id"] = np.full(len(payload), tag_id, dtype=np.int64)
+        else:
+            # Last byte of the (reversed) advertising address
+            columns["tag_id"] = records["ble_adv_addr"][mask, 0].astype(np.int64)
+        # TODO: determine channel packet was received on
+        del records, payload
+    return columns
+
+
+def calibrated(datapoints):
+    ''' A table's packets with their RSSI calibrated with the table in use. '''
+    if calibration.active() is None:
+        return datapoints
+    return DataPoints(datapoints.tag_id, datapoints.sequence_num, datapoints.timestamp,
+        calibration.calibrate(datapoints.tag_id, datapoints.channel, datapoints.rssi),
+        datapoints.channel)
+
+
+def write_table(f, header, columns):
+    ''' Write equal-length columns as CSV rows in one bulk call.
+
+    NaNs and Nones are written as empty fields.
+    '''
+    fields = []
+    for column in columns:
+        column = np.asarray(column)
+        if column.dtype.kind == "f" and np.isnan(column).any():
+            column = np.where(np.isnan(column), None, column.astype(object))
+        fields.append(column.tolist())
+    writer = csv.writer(f)
+    writer.writerow(header)
+    writer.writerows(zip(*fields))
+
+
+def write_processed(datapoints, f):
+    ''' Write the sparse _processed.csv layout: one row per packet, with
+    its RSSI under its tag's column and the other columns empty. '''
+    ids = datapoints.get_ids()
+    csv.writer(f).writerow(["Timestamp"] + ids)
+    # Every tag's rows have the same layout, so each is one format string
+    templates = ["%d," + "," * i + "%d" + "," * (len(ids) - 1 - i) + "\r\n" for i in range(len(ids))]
+    f.write("".join(map(str.__mod__, [templates[i] for i in datapoints.tag_index.tolist()],
+        zip(datapoints.timestamp.tolist(), datapoints.rssi.tolist()))))
@@ -0,0 +1,120 @@
+''' Discovery and parallel loading of experiment trees.
+
+Every directory holding a raw.csv is a capture. Its path below the root
+is read from the end: each directory name is a comma-separated list of
+fields, such as "10 cm, 0 deg", "Tags 90 deg, Receiver 180 deg",
+"Tag 1, 0 deg" or "Take 2". The first name from the end that is not
+such a list, and everything above it, names the experiment (e.g.
+"Orientation/Model").
+'''
+
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import re
+from parse_cache import load_csv
+
+
+Capture = collections.namedtuple("Capture",
+    ["experiment", "tag", "radius", "angle", "tag_angle", "receiver_angle", "take"])
+Capture.__new__.__defaults__ = (None,) * len(Capture._fields)
+
+NUMBER = r"(\d+(?:\.\d+)?)"
+FIELDS = [
+    (re.compile(r"{} cm$".format(NUMBER)), "radius"),
+    (re.compile(r"Tags {} deg$".format(NUMBER)), "tag_angle"),
+    (re.compile(r"Receiver {} deg$".format(NUMBER)), "receiver_angle"),
+    (re.compile(r"{} deg$".format(NUMBER)), "angle"),
+    (re.compile(r"Tag (\d+)$"), "tag"),
+    (re.compile(r"Take (\d+)$"), "take"),
+]
+
+
+def __number(field, text):
+    # Angles are always floats, so 0 deg and 0.0 deg are the same key
+    if field.endswith("angle") or "." in text:
+        return float(text)
+    return int(text)
+
+
+def parse_name(name):
+    ''' Parse a capture directory name into a dict of fields, or None. '''
+    fields = {}
+    for part in name.split(","):
+        part = part.strip()
+        for pattern, field in FIELDS:
+            match = pattern.match(part)
+            if match:
+                break
+        else:
+            return None
+        if field in fields:
+            raise ValueError("{} given twice in {!r}".format(field, name))
+        fields[field] = __number(field, match.group(1))
+    return fields
+
+
+def parse_path(path):
+    ''' Parse a capture directory path, relative to its root, into a Capture. '''
+    parts = os.path.normpath(path).split(os.sep)
+    fields = {}
+    while parts:
+        parsed = parse_name(parts[-1])
+        if parsed is None:
+            break
+        for field, value in parsed.items():
+            if field in fields:
+                raise ValueError("{} given twice in {!r}".format(field, path))
+            fields[field] = value
+        parts.pop()
+    experiment = "/".join(p for p in parts if p != os.curdir)
+    return Capture(experiment=experiment, **fields)
+
+
+def find_captures(root=os.curdir):
+    ''' Find every capture under root, in path order, as (Capture, raw.csv path). '''
+    captures = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if "raw.csv" in filenames:
+            captures.append((parse_path(os.path.relpath(dirpath, root)),
+                os.path.join(dirpath, "raw.csv")))
+    return captures
+
+
+def pool_map(fn, items, workers=None):
+    ''' Map fn over items across a process pool, in order.
+
+    Uses os.cpu_count() processes unless `workers` is given, and runs in
+    this process if there is only one to use.
+    '''
+    items = list(items)
+    workers = min(workers or os.cpu_count() or 1, len(items))
+    if workers <= 1:
+        return [fn(item) for item in items]
+    # The plot scripts have no __main__ guard, which the spawn and
+    # forkserver start methods would re-run in every worker
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+        return list(pool.map(fn, items, chunksize=max(1, len(items) // (4 * workers))))
+
+
+def load_dataset(root=os.curdir, workers=None, calibrate=True):
+    ''' Load every capture under root, parsing them across a process pool.
+
+    Returns a dict of DataPoints keyed by Capture, in path order. Uses
+    os.cpu_count() processes unless `workers` is given. RSSI is
+    calibrated as load_csv calibrates it.
+    '''
+    captures = find_captures(root)
+    paths = [path for _, path in captures]
+    tables = pool_map(functools.partial(load_csv, calibrate=calibrate), paths, workers)
+    dataset = collections.OrderedDict()
+    for (capture, path), datapoints in zip(captures, tables):
+        if capture in dataset:
+            raise ValueError("{} and another capture have the same fields".format(path))
+        dataset[capture] = datapoints
+    return dataset
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+''' Cross-validation of the fingerprint model over the Orientation captures.
+
+Every tag in a capture is one labelled sample: its mean RSSI on each
+channel and the radius, azimuth and orientation it was captured at.
+Captures with the same setup are pooled into a space, and each space is
+cross-validated on its own, holding out whole captures: one at a time
+(leave-one-capture-out) or in k random folds. Each fold trains a Model
+on the remaining captures, averaging cells captured more than once, and
+predicts the held-out samples in four tasks: each axis with the other
+two given, and all three jointly. Folds run in parallel.
+
+A held-out sample whose cell was captured in no other fold cannot be
+predicted correctly, as its cell is not in the fold's model; such
+samples are scored apart, as unseen, and left out of the accuracy and
+error statistics. With one capture per cell (each tag of Calibration,
+most cells of the ring), leave-one-capture-out leaves every sample
+unseen; spaces with no other samples are not scored at all.
+
+The spaces are the 8 tag ring (Model and the Radial sets), the single
+tag of Angular Continuity, and each tag of Calibration. Linear is left
+out, as which tag sat where along the line was not recorded.
+
+Run as a script, it writes CSV files to the output directory:
+
+  summary.csv      accuracy and mean and standard deviation of the error per
+                   space, task and axis, over the samples of seen cells
+  predictions.csv  every sample's true and predicted values per task, and
+                   whether its cell was seen
+  histograms.csv   number of predictions per error
+  confusion.csv    number of predictions per true and predicted value
+'''
+
+import argparse
+import collections
+import csv
+import os
+import numpy as np
+from datapoints import CHANNELS
+from aggregate import group_stats
+from dataset import load_dataset, pool_map
+from filters import FILTERS, filter_rssi, make_filters
+from model import Model
+
+
+def __ring(facing, radius=None):
+    ''' Ring of 8 tags; facing gives a tag's absolute orientation from its azimuth. '''
+    def label(capture, tag):
+        azimuth = Model._Model__abs_azimuth(tag)
+        return ("Ring", capture.radius if radius is None else radius,
+            Model._Model__rel_angle(azimuth, capture.angle),
+            Model._Model__rel_angle(facing(azimuth), capture.angle))
+    return label
+
+
+def __single(space, radius=None):
+    ''' One tag rotated in front of a fixed receiver; its azimuth is unknown, so 0. '''
+    def label(capture, tag):
+        return (space(capture) if callable(space) else space,
+            capture.radius if radius is None else radius, 0.0, capture.angle)
+    return label
+
+
+# How to label the tags of each experiment, as (space, radius, azimuth, orientation)
+GEOMETRY = {
+    "Model": __ring(lambda azimuth: 270.0),
+    "Radial Straight": __ring(lambda azimuth: 270.0, 50),
+    "Radial Inward": __ring(lambda azimuth: azimuth + 180.0, 50),
+    "Radial Outward": __ring(lambda azimuth: azimuth, 50),
+    # Tags are numbered clockwise, with azimuths decreasing
+    "Radial CW": __ring(lambda azimuth: azimuth - 90.0, 50),
+    "Radial CCW": __ring(lambda azimuth: azimuth + 90.0, 50),
+    "Angular Continuity/Multiple distances": __single("Angular Continuity"),
+    "Angular Continuity/One distance": __single("Angular Continuity", 20),
+    "Angular Continuity/One distance (original)": __single("Angular Continuity", 20),
+    "Calibration": __single(lambda capture: "Calibration/Tag {}".format(capture.tag)),
+}
+
+# Each task: the axes predicted, with the others given
+TASKS = collections.OrderedDict([
+    ("radius", [0]),
+    ("azimuth", [1]),
+    ("orientation", [2]),
+    ("joint", [0, 1, 2]),
+])
+
+# Errors along these axes wrap around at 360 degrees
+ANGULAR = [False, True, True]
+
+Score = collections.namedtuple("Score", ["space", "task", "axis", "count", "predicted",
+    "accuracy", "mean_error", "sd_error", "histogram", "confusion", "unseen"])
+Score.__doc__ = ''' Results of one task along one axis. `count` samples of
+seen cells were tested, of which `predicted` got a prediction; `unseen`
+more, whose cells were not in their fold's model, were left out.
+`histogram` is (errors, counts) and `confusion` is (values, counts),
+counts[true, predicted]. '''
+
+
+def __geometry(experiment):
+    for name, label in GEOMETRY.items():
+        if experiment == name or experiment.endswith("/" + name):
+            return label
+    return None
+
+
+def label_capture(capture, tag):
+    ''' (space, radius, azimuth, orientation) of a tag in a capture, or None if unknown. '''
+    label = __geometry(capture.experiment)
+    return None if label is None else label(capture, tag)
+
+
+def label_samples(dataset, channels=CHANNELS, rssi_filter=None):
+    ''' Turn a dataset into labelled samples, one per tag per capture.
+
+    Returns a dict of parallel arrays: "space", "experiment", "capture"
+    (its position in the dataset), "tag", "truth" (radius, azimuth,
+    orientation) and "fingerprint". Experiments of unknown geometry are
+    skipped. Fingerprints are of RSSI run through `rssi_filter`, a list
+    of filters (see filters.py), if given.
+    '''
+    columns = dict((key, []) for key in ["space", "experiment", "capture", "tag",
+        "truth", "fingerprint"])
+    for i, (capture, datapoints) in enumerate(dataset.items()):
+        label = __geometry(capture.experiment)
+        if label is None:
+            continue
+        stats = group_stats(datapoints, channels,
+            filter_rssi(datapoints, rssi_filter) if rssi_filter else None)
+        for tag, fingerprint in zip(stats.ids, stats.mean):
+            space, radius, azimuth, orientation = label(capture, tag)
+            columns["space"].append(space)
+            columns["experiment"].append(capture.experiment)
+            columns["capture"].append(i)
+            columns["tag"].append(tag)
+            columns["truth"].append((radius, azimuth, orientation))
+            columns["fingerprint"].append(fingerprint)
+    return {
+        "space": np.array(columns["space"], dtype=str),
+        "experiment": np.array(columns["experiment"], dtype=str),
+        "capture": np.array(columns["capture"], dtype=np.intp),
+        "tag": np.array(columns["tag"], dtype=np.intp),
+        "truth": np.array(columns["truth"], dtype=np.float64).reshape(-1, 3),
+        "fingerprint": np.array(columns["fingerprint"], dtype=np.float64).reshape(-1, len(channels)),
+    }
+
+
+def train(truth, fingerprints, channels=CHANNELS):
+    ''' Build a Model from samples, averaging those of the same cell. '''
+    cells, inverse = np.unique(truth, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    total = np.zeros((len(cells), len(channels)))
+    np.add.at(total, inverse, fingerprints)
+    model = Model(channels)
+    if len(cells):
+        model.add_cells(cells[:, 0], cells[:, 1], cells[:, 2],
+            total / np.bincount(inverse)[:, None])
+    return model
+
+
+def predict(model, truth, fingerprints, ord=2):
+    ''' Predict samples in every task; returns a dict of (N, 3) arrays by task.
+
+    Only the predicted axes are filled in. Samples whose given values are
+    not in the model, or with no candidate cell, are NaN.
+    '''
+    predictions = collections.OrderedDict()
+    for task, free in TASKS.items():
+        predicted = np.full(truth.shape, np.nan)
+        fixed = [axis for axis in range(len(Model.AXES)) if axis not in free]
+        known = np.ones(len(truth), dtype=bool)
+        for axis in fixed:
+            known &= np.isin(truth[:, axis], model.values[axis])
+        if known.any():
+            best = model.predict_batch(fingerprints[known], free_axes=free, ord=ord,
+                **dict((Model.AXES[axis], truth[known, axis]) for axis in fixed)).best
+            predicted[np.ix_(known, free)] = best[:, free]
+        predictions[task] = predicted
+    return predictions
+
+
+def __rows(cells):
+    ''' Each row of an (N, 3) array as one value, for comparing whole cells. '''
+    # Adding 0 turns -0.0 into 0.0, which would otherwise compare unequal
+    cells = np.ascontiguousarray(cells + 0.0)
+    return cells.view(np.dtype((np.void, cells.dtype.itemsize * cells.shape[1]))).reshape(-1)
+
+
+def __run_fold(fold):
+    train_truth, train_fingerprints, test_truth, test_fingerprints, channels, ord = fold
+    return predict(train(train_truth, train_fingerprints, channels),
+        test_truth, test_fingerprints, ord)
+
+
+def assign_folds(samples, k=None, seed=0):
+    ''' Split every space's captures into k folds, or one per capture if k is None. '''
+    folds = np.zeros(len(samples["capture"]), dtype=np.intp)
+    rng = np.random.default_rng(seed)
+    for space in np.unique(samples["space"]):
+        rows = samples["space"] == space
+        captures, inverse = np.unique(samples["capture"][rows], return_inverse=True)
+        order = np.arange(len(captures))
+        if k is not None:
+            order = rng.permutation(len(captures)) % min(k, len(captures))
+        folds[rows] = order[inverse.reshape(-1)]
+    return folds
+
+
+def cross_validate(samples, k=None, ord=2, seed=0, workers=None, channels=CHANNELS):
+    ''' Cross-validate every space, holding out one capture or one of k folds at a time.
+
+    Returns (folds, predictions, seen): each sample's fold within its
+    space, a dict of (N, 3) predictions by task, as from predict, and
+    whether each sample's cell was in the model of its fold. Folds run
+    across a process pool.
+    '''
+    folds = assign_folds(samples, k, seed)
+    seen = np.zeros(len(folds), dtype=bool)
+    jobs, tests = [], []
+    for space in np.unique(samples["space"]):
+        rows = samples["space"] == space
+        for fold in np.unique(folds[rows]):
+            test = rows & (folds == fold)
+            held_in = rows & ~test
+            jobs.append((samples["truth"][held_in], samples["fingerprint"][held_in],
+                samples["truth"][test], samples["fingerprint"][test], list(channels), ord))
+            tests.append(test)
+            seen[test] = np.isin(__rows(samples["truth"][test]), __rows(samples["truth"][held_in]))
+
+    predictions = collections.OrderedDict((task, np.full(samples["truth"].shape, np.nan))
+        for task in TASKS)
+    for test, result in zip(tests, pool_map(__run_fold, jobs, workers)):
+        for task, predicted in result.items():
+            predictions[task][test] = predicted
+    return folds, predictions, seen
+
+
+def errors(truth, predicted, axis):
+    ''' Prediction errors along an axis, with angles wrapped into [-180, 180). '''
+    error = predicted - truth
+    if ANGULAR[axis]:
+        error = (error + 180.0) % 360.0 - 180.0
+    return error
+
+
+def score(truth, predicted, axis, space="", task="", seen=None):
+    ''' Accuracy, error statistics, error histogram and confusion matrix along an axis.
+
+    Only samples whose cells were `seen` (all, if not given) are scored;
+    the others are counted as unseen.
+    '''
+    seen = np.ones(len(truth), dtype=bool) if seen is None else seen
+    truth, predicted = truth[seen, axis], predicted[seen, axis]
+    valid = ~np.isnan(predicted)
+    error = errors(truth[valid], predicted[valid], axis)
+    values = np.union1d(truth, predicted[valid])
+    confusion = np.zeros((len(values), len(values)), dtype=np.int64)
+    np.add.at(confusion, (np.searchsorted(values, truth[valid]),
+        np.searchsorted(values, predicted[valid])), 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return Score(space, task, Model.AXES[axis], len(truth), int(valid.sum()),
+            float(np.count_nonzero(error == 0) / len(truth)) if len(truth) else np.nan,
+            float(np.mean(error)) if len(error) else np.nan,
+            float(np.std(error, ddof=1)) if len(error) > 1 else np.nan,
+            np.unique(error, return_counts=True), (values, confusion),
+            int(np.count_nonzero(~seen)))
+
+
+def score_all(samples, predictions, seen=None):
+    ''' Score every space, task and predicted axis, over the samples of seen cells.
+
+    Axes that are the same for every sample of a space (the azimuth of a
+    single tag) have nothing to predict and are left out, as are spaces
+    with no sample of a seen cell (see unscored).
+    '''
+    scores = []
+    for space in np.unique(samples["space"]):
+        rows = samples["space"] == space
+        if seen is not None and not seen[rows].any():
+            continue
+        varied = [len(np.unique(samples["truth"][rows, axis])) > 1 for axis in range(len(Model.AXES))]
+        for task, free in TASKS.items():
+            for axis in [axis for axis in free if varied[axis]]:
+                scores.append(score(samples["truth"][rows], predictions[task][rows],
+                    axis, space, task, None if seen is None else seen[rows]))
+    return scores
+
+
+def unscored(samples, seen):
+    ''' Spaces whose every sample's cell was unseen, with their numbers of samples. '''
+    return collections.OrderedDict((space, int(np.count_nonzero(samples["space"] == space)))
+        for space in np.unique(samples["space"]) if not seen[samples["space"] == space].any())
+
+
+def __number(value):
+    return "" if np.isnan(value) else round(float(value), 4)
+
+
+def write_csv(outdir, samples, folds, predictions, scores, seen):
+    ''' Write the summary, predictions, histograms and confusion matrices as CSV files. '''
+    os.makedirs(outdir, exist_ok=True)
+    tables = collections.OrderedDict()
+    tables["summary"] = [["Space", "Task", "Axis", "Count", "Predicted", "Accuracy",
+        "Mean Error", "SD Error", "Unseen"]] + [[s.space, s.task, s.axis, s.count, s.predicted,
+            __number(s.accuracy), __number(s.mean_error), __number(s.sd_error), s.unseen]
+        for s in scores]
+    tables["predictions"] = [["Space", "Experiment", "Capture", "Tag", "Fold", "Seen", "Task"]
+        + ["True " + axis.title() for axis in Model.AXES] + [axis.title() for axis in Model.AXES]]
+    for task, predicted in predictions.items():
+        for i in range(len(samples["space"])):
+            tables["predictions"].append([samples["space"][i], samples["experiment"][i],
+                samples["capture"][i], samples["tag"][i], folds[i], int(seen[i]), task]
+                + [__number(v) for v in samples["truth"][i]] + [__number(v) for v in predicted[i]])
+    tables["histograms"] = [["Space", "Task", "Axis", "Error", "Count"]] + [
+        [s.space, s.task, s.axis, __number(e), c] for s in scores for e, c in zip(*s.histogram)]
+    tables["confusion"] = [["Space", "Task", "Axis", "True", "Predicted", "Count"]] + [
+        [s.space, s.task, s.axis, __number(t), __number(p), s.confusion[1][i, j]]
+        for s in scores
+        for i, t in enumerate(s.confusion[0])
+        for j, p in enumerate(s.confusion[0])
+        if s.confusion[1][i, j]]
+    for table, rows in tables.items():
+        with open(os.path.join(outdir, table + ".csv"), "w", newline="") as f:
+            csv.writer(f).writerows(rows)
+    return tables
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    arg_parser = argparse.ArgumentParser(
+        description="cross-validate the fingerprint model over the orientation captures")
+    arg_parser.add_argument("root",
+        help="directory of the captures (default: Orientation)",
+        nargs="?",
+        default=os.path.join(here, "Orientation"))
+    arg_parser.add_argument("-k", "--folds",
+        help="number of folds per space (default: leave one capture out)",
+        type=int)
+    arg_parser.add_argument("--ord",
+        help="order of the fingerprint distance norm (default: 2)",
+        type=int,
+        default=2)
+    arg_parser.add_argument("--seed",
+        help="seed for splitting captures into folds",
+        type=int,
+        default=0)
+    arg_parser.add_argument("-o", "--outdir",
+        help="directory to write the tables to",
+        default="evaluation")
+    arg_parser.add_argument("-j", "--jobs",
+        help="number of processes (default: one per core)",
+        type=int)
+    arg_parser.add_argument("-F", "--filter",
+        help="filters to run each tag and channel's RSSI through, in order",
+        nargs="+", choices=list(FILTERS), default=[])
+    args = arg_parser.parse_args()
+    if args.folds is not None and args.folds < 2:
+        arg_parser.error("need at least 2 folds")
+
+    samples = label_samples(load_dataset(args.root, args.jobs), rssi_filter=make_filters(args.filter))
+    folds, predictions, seen = cross_validate(samples, args.folds, args.ord, args.seed, args.jobs)
+    scores = score_all(samples, predictions, seen)
+    write_csv(args.outdir, samples, folds, predictions, scores, seen)
+    for s in scores:
+        print("{}, {} ({}): {:.4}%, error: {:.4}, stdev: {:.4} ({} of {} samples unseen)".format(
+            s.space, s.task, s.axis, 100 * s.accuracy, s.mean_error, s.sd_error,
+            s.unseen, s.count + s.unseen))
+    for space, count in unscored(samples, seen).items():
+        print("{}: not scored, all {} samples unseen".format(space, count))
@@ -0,0 +1,184 @@
+''' RSSI smoothing and outlier rejection, per (tag, channel) series.
+
+A filter runs over each series of RSSI values in the order the packets
+arrived, one value per packet, whatever the time between them. Filters
+are chained by listing them, as in [Hampel(), Kalman()], each taking in
+the previous one's output.
+
+Every filter has two implementations with the same results: apply,
+which filters all of a capture's series at once, and step, which
+filters one value at a time in constant memory per series (see
+StreamingFilter).
+'''
+
+import collections
+import numpy as np
+
+
+class Hampel:
+    ''' Replaces a value by the median of the last `window` values (its own
+    included) when it is more than `threshold` standard deviations from it.
+
+    The standard deviation is estimated from the median absolute
+    deviation, but taken as at least `min_sd`, as whole-dBm RSSI often
+    has none.
+    '''
+    def __init__(self, window=7, threshold=3.0, min_sd=1.0):
+        self.window = window
+        self.threshold = threshold
+        self.min_sd = min_sd
+
+    def __repr__(self):
+        return "Hampel({!r}, {!r}, {!r})".format(self.window, self.threshold, self.min_sd)
+
+    def __reject(self, value, median, mad):
+        limit = self.threshold * max(1.4826 * mad, self.min_sd)
+        return median if abs(value - median) > limit else value
+
+    @staticmethod
+    def __median(rows, size):
+        ''' Median of each row's first `size` values, the rest being NaN and sorted last. '''
+        rows = np.sort(rows, axis=1)
+        rows_index = np.arange(len(rows))
+        return (rows[rows_index, (size - 1) // 2] + rows[rows_index, size // 2]) / 2
+
+    def apply(self, values, position):
+        lag = np.arange(self.window)
+        index = np.arange(len(values))[:, None] - lag
+        size = np.minimum(position + 1, self.window)
+        window = np.where(lag < size[:, None], values[np.maximum(index, 0)], np.nan)
+        median = self.__median(window, size)
+        mad = self.__median(np.abs(window - median[:, None]), size)
+        limit = self.threshold * np.maximum(1.4826 * mad, self.min_sd)
+        return np.where(np.abs(values - median) > limit, median, values)
+
+    def start(self):
+        return collections.deque(maxlen=self.window)
+
+    def step(self, state, value):
+        state.append(value)
+        window = sorted(state)
+        size = len(window)
+        median = (window[(size - 1) // 2] + window[size // 2]) / 2
+        deviations = sorted(abs(x - median) for x in state)
+        mad = (deviations[(size - 1) // 2] + deviations[size // 2]) / 2
+        return self.__reject(value, median, mad)
+
+
+class _Recursive:
+    ''' A filter of the form y = y + gain * (x - y), the gain depending only
+    on how many values came before. '''
+    def gains(self, length):
+        gains = []
+        state = self.start()
+        for _ in range(length):
+            gains.append(self._gain(state))
+        return np.array(gains)
+
+    def apply(self, values, position):
+        # Every series moves a step at a time, together: the values at each
+        # position follow on from those just before them
+        length = int(position.max()) + 1 if len(position) else 0
+        order = np.argsort(position, kind="stable")
+        bounds = np.cumsum(np.bincount(position, minlength=length))
+        gains = self.gains(length)
+        result = np.array(values, dtype=np.float64)
+        for p in range(1, length):
+            index = order[bounds[p - 1]:bounds[p]]
+            last = result[index - 1]
+            result[index] = last + gains[p] * (values[index] - last)
+        return result
+
+    def step(self, state, value):
+        gain = self._gain(state)
+        state[0] = value if state[0] is None else state[0] + gain * (value - state[0])
+        return state[0]
+
+
+class EMA(_Recursive):
+    ''' Exponential moving average with weight `alpha` on the newest value. '''
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+
+    def __repr__(self):
+        return "EMA({!r})".format(self.alpha)
+
+    def start(self):
+        return [None, 0]
+
+    def _gain(self, state):
+        state[1] += 1
+        return 1.0 if state[1] == 1 else self.alpha
+
+
+class Kalman(_Recursive):
+    ''' One-dimensional Kalman filter of a random walk: the RSSI wanders by
+    `process_var` dBm^2 per packet and is measured with `measurement_var`. '''
+    def __init__(self, process_var=0.05, measurement_var=4.0):
+        self.process_var = process_var
+        self.measurement_var = measurement_var
+
+    def __repr__(self):
+        return "Kalman({!r}, {!r})".format(self.process_var, self.measurement_var)
+
+    def start(self):
+        # Estimate and its variance, infinite before the first measurement
+        return [None, np.inf]
+
+    def _gain(self, state):
+        prior = state[1] + self.process_var
+        gain = 1.0 if prior == np.inf else prior / (prior + self.measurement_var)
+        state[1] = self.measurement_var if prior == np.inf else (1 - gain) * prior
+        return gain
+
+
+FILTERS = collections.OrderedDict([
+    ("hampel", Hampel),
+    ("ema", EMA),
+    ("kalman", Kalman),
+])
+
+
+def make_filters(names):
+    ''' Filters with their default parameters, by name (see FILTERS). '''
+    return [FILTERS[name]() for name in names]
+
+
+def apply_filters(filters, values, series):
+    ''' Filter values all at once, each series of equal keys in `series` on its own. '''
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(series, kind="stable")
+    keys = np.asarray(series)[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    position = np.arange(len(keys)) - starts[np.cumsum(first) - 1]
+    filtered = values[order]
+    for f in filters:
+        filtered = f.apply(filtered, position)
+    result = np.empty(len(values))
+    result[order] = filtered
+    return result
+
+
+def filter_rssi(datapoints, filters):
+    ''' Every packet's RSSI, filtered along its (tag, channel) series. '''
+    return apply_filters(filters, datapoints.rssi,
+        datapoints.tag_index.astype(np.int64) * 256 + datapoints.channel)
+
+
+class StreamingFilter:
+    ''' Filters packets one at a time, keeping each (tag, channel) series' state. '''
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.states = {}
+
+    def add(self, tag_id, channel, rssi):
+        ''' The filtered RSSI of one packet. '''
+        states = self.states.get((tag_id, channel))
+        if states is None:
+            states = self.states[(tag_id, channel)] = [f.start() for f in self.filters]
+        value = float(rssi)
+        for f, state in zip(self.filters, states):
+            value = f.step(state, value)
+        return value
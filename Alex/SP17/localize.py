@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+''' Locate tags in real time from a scanner's serial output.
+
+Packets are read as analyze.py reads them, on a capture.PortReader
+thread, into a sliding window of per-tag, per-channel RSSI means. At a
+fixed rate every tag with packets on every channel in the window is
+located with the fingerprint model, and one JSON line per tag is written
+to stdout or to every client of a local TCP port:
+
+  {"tag": 1, "radius": 30.0, "azimuth": 45.0, "orientation": 90.0,
+   "distance": 1.2, "packets": 28, "time": 1500000000.1, "latency_ms": 3.1}
+
+`latency_ms` is the time from the tag's newest packet being read from
+the port to its estimate being written, or null if no packet of the tag
+was read since the last estimate, whose packets were all older. Latency and the time spent per
+tick are summarized on stderr every few seconds, along with the ticks
+that were skipped because the previous one ran late.
+
+Packets from several ports are pooled by tag ID. A CSV capture can be
+replayed in place of a serial port, at its own pace or faster, to try
+out the model or check that the daemon keeps up; the window then spans
+`window` seconds of the capture rather than of the host clock.
+'''
+
+import argparse
+import collections
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import numpy as np
+import calibration
+from aggregate import SlidingMeans
+from capture import PortReader
+from datapoints import read_csv
+from filters import FILTERS, StreamingFilter, make_filters
+from model import Model
+
+
+class Replay(threading.Thread):
+    ''' Plays a CSV capture back as a PortReader would read it, `speed` times as fast.
+
+    Timestamps are relative to the capture's first packet, whose time
+    on the replay's clock is 0.
+    '''
+    def __init__(self, path, receiver, stop, speed=1.0, tag_id=None, on_packet=None):
+        super().__init__(name="replay {}".format(path), daemon=True)
+        self.path = path
+        self.receiver = receiver
+        self.stop = stop
+        self.speed = speed
+        self.tag_id = tag_id
+        self.on_packet = on_packet
+        self.start_time = None
+        self.error = None
+
+    def clock(self):
+        ''' Seconds of the capture played back so far. '''
+        if self.start_time is None:
+            return 0.0
+        return (time.time() - self.start_time) * self.speed
+
+    def run(self):
+        try:
+            self.__play()
+        except Exception as e:
+            self.error = e
+
+    def __play(self):
+        with open(self.path) as f:
+            datapoints = read_csv(f, tag_id=self.tag_id, calibrate=False)
+        start = self.start_time = time.time()
+        for packet in zip(datapoints.tag_id.tolist(), datapoints.sequence_num.tolist(),
+                datapoints.timestamp.tolist(), datapoints.rssi.tolist(),
+                datapoints.channel.tolist()):
+            if self.stop.is_set():
+                break
+            delay = start + packet[2] / 1000 / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.on_packet(self.receiver, time.time(), *packet)
+
+
+class Broadcast:
+    ''' Writes lines to stdout, or to every client of a TCP port on localhost.
+
+    Clients are written to without blocking: what a client's socket does
+    not take at once is buffered for the next write, and a client is
+    dropped once more than `max_buffer` bytes are waiting for it, so that
+    a stalled client never holds up the rest.
+    '''
+    def __init__(self, port=None, max_buffer=2**20):
+        self.server = None
+        self.clients = []
+        self.buffers = {}
+        self.max_buffer = max_buffer
+        if port is not None:
+            self.server = socket.create_server(("127.0.0.1", port))
+            self.server.setblocking(False)
+
+    def write(self, lines):
+        if self.server is None:
+            sys.stdout.write("".join(line + "\n" for line in lines))
+            sys.stdout.flush()
+            return
+        while select.select([self.server], [], [], 0)[0]:
+            client, _ = self.server.accept()
+            client.setblocking(False)
+            self.clients.append(client)
+            self.buffers[client] = b""
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        for client in list(self.clients):
+            pending = self.buffers[client] + data
+            try:
+                pending = pending[client.send(pending):]
+            except BlockingIOError:
+                # Nothing sent; kept until the client reads again or falls too far behind
+                pass
+            except OSError:
+                pending = None
+            if pending is None or len(pending) > self.max_buffer:
+                self.__drop(client)
+            else:
+                self.buffers[client] = pending
+
+    def __drop(self, client):
+        client.close()
+        self.clients.remove(client)
+        del self.buffers[client]
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        if self.server is not None:
+            self.server.close()
+
+
+class Localizer:
+    ''' Locates the tags in a sliding window with a fingerprint model.
+
+    Axes given in `given` (e.g. {"radius": 50}) are held fixed and the
+    others searched jointly, through the model's KD-tree when every axis
+    is free and SciPy is installed. Packets' RSSI is calibrated with the
+    table in use (see calibration.py), then run through `rssi_filter`, a
+    list of filters (see filters.py), if given, as the model's should
+    have been.
+
+    The window runs on the host clock, or, given `clock` (as a Replay's),
+    on packets' timestamps, with `clock()` the current time in seconds.
+    '''
+    def __init__(self, model, window=2.0, ord=2, given=None, rssi_filter=None, clock=None):
+        self.model = model
+        self.smoother = StreamingFilter(rssi_filter) if rssi_filter else None
+        self.calibration = calibration.active()
+        self.ord = ord
+        self.given = dict(given or {})
+        self.free_axes = [axis for axis in Model.AXES if axis not in self.given]
+        self.means = SlidingMeans(window, model.channels)
+        self.clock = clock
+        # Host time each tag's newest packet was read at, for the latency
+        self.newest = {}
+        self.lock = threading.Lock()
+        if not self.given:
+            try:
+                model.build_tree()
+            except ImportError:
+                pass
+
+    def add(self, receiver, host_time, tag_id, sequence_num, timestamp, rssi, channel):
+        ''' Take one packet, as a PortReader's on_packet. '''
+        with self.lock:
+            if self.calibration:
+                rssi += self.calibration.offset(tag_id, channel)
+            if self.smoother:
+                rssi = self.smoother.add(tag_id, channel, rssi)
+            self.means.add(timestamp / 1000 if self.clock else host_time, tag_id, rssi, channel)
+            self.newest[tag_id] = host_time
+
+    def estimate(self, now):
+        ''' Estimates of every tag heard on every channel, as dicts. '''
+        with self.lock:
+            ids, mean, count, _ = self.means.means(self.clock() if self.clock else now)
+            newest = np.array([self.newest[tag] for tag in ids])
+        complete = (count > 0).all(axis=1)
+        if not complete.any():
+            return []
+        predictions = self.model.predict_batch(mean[complete], free_axes=self.free_axes,
+            ord=self.ord, **self.given)
+        return [dict([("tag", tag)]
+                + list(zip(Model.AXES, values))
+                + [("distance", round(distance, 3)), ("packets", packets), ("newest", newest_time)])
+            for tag, values, distance, packets, newest_time in zip(
+                np.array(ids)[complete].tolist(), predictions.best.tolist(),
+                predictions.distances[:, 0].tolist(), count[complete].sum(axis=1).tolist(),
+                newest[complete].tolist())]
+
+
+def __percentiles(values):
+    if not values:
+        return "-"
+    p50, p99, top = np.percentile(values, [50, 99, 100])
+    return "{:.2f}/{:.2f}/{:.2f} ms".format(p50, p99, top)
+
+
+def run(localizer, sources, rate=10.0, output=None, report=5.0, duration=None):
+    ''' Estimate every 1/rate seconds while any source is alive, or for `duration` seconds. '''
+    output = output or Broadcast()
+    period = 1.0 / rate
+    start = next_tick = last_report = time.time()
+    # Packets read before this were in the last tick's estimates
+    last_estimate = float("-inf")
+    latencies = collections.deque(maxlen=10000)
+    compute = collections.deque(maxlen=10000)
+    ticks = skipped = 0
+    while any(source.is_alive() for source in sources):
+        now = time.time()
+        if duration is not None and now - start >= duration:
+            break
+        if next_tick > now:
+            time.sleep(next_tick - now)
+        now = time.time()
+        estimates = localizer.estimate(now)
+        lines = []
+        for estimate in estimates:
+            estimate["time"] = round(now, 3)
+            newest = estimate.pop("newest")
+            estimate["latency_ms"] = None
+            if newest > last_estimate:
+                estimate["latency_ms"] = round((time.time() - newest) * 1000, 3)
+                latencies.append(estimate["latency_ms"])
+            lines.append(json.dumps(estimate))
+        last_estimate = now
+        if lines:
+            output.write(lines)
+        done = time.time()
+        compute.append((done - now) * 1000)
+        ticks += 1
+
+        # Ticks the last one ran into are skipped rather than run late
+        next_tick += period
+        if next_tick < done:
+            missed = int((done - next_tick) // period) + 1
+            skipped += missed
+            next_tick += missed * period
+        if report and done - last_report >= report:
+            print("{:.1f} s: {} ticks, {} skipped; latency p50/p99/max {}; tick {}".format(
+                done - start, ticks, skipped, __percentiles(latencies), __percentiles(compute)),
+                file=sys.stderr, flush=True)
+            last_report = done
+    for source in sources:
+        if source.error:
+            raise source.error
+    return ticks, skipped
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    arg_parser = argparse.ArgumentParser(
+        description="locate tags in real time from serial ports or replayed captures")
+    arg_parser.add_argument("infiles",
+        help="serial port(s), or CSV capture(s) to replay",
+        nargs="+")
+    arg_parser.add_argument("-m", "--model",
+        help="directory of the model's captures (default: Orientation/Model)",
+        default=os.path.join(here, "Orientation", "Model"))
+    arg_parser.add_argument("-R", "--resolution",
+        help="match against the model's interpolated field, with radii every "
+             "RADIUS cm and angles every ANGLE degrees",
+        type=float, nargs=2, metavar=("RADIUS", "ANGLE"))
+    arg_parser.add_argument("-f", "--rate",
+        help="estimates per second (default: 10)",
+        type=float, default=10.0)
+    arg_parser.add_argument("-w", "--window",
+        help="length in seconds of the sliding window (default: 2)",
+        type=float, default=2.0)
+    arg_parser.add_argument("-p", "--port",
+        help="serve estimates on this TCP port on localhost instead of stdout",
+        type=int)
+    arg_parser.add_argument("--radius",
+        help="radius of every tag (centimeters), if known",
+        type=float)
+    arg_parser.add_argument("--azimuth",
+        help="azimuth of every tag (degrees), if known",
+        type=float)
+    arg_parser.add_argument("--orientation",
+        help="orientation of every tag (degrees), if known",
+        type=float)
+    arg_parser.add_argument("--ord",
+        help="order of the fingerprint distance norm (default: 2)",
+        type=int, default=2)
+    arg_parser.add_argument("-F", "--filter",
+        help="filters to run each tag and channel's RSSI through, in order, "
+             "for the model and the estimates alike",
+        nargs="+", choices=list(FILTERS), default=[])
+    arg_parser.add_argument("-s", "--speed",
+        help="replay captures this many times as fast (default: 1)",
+        type=float, default=1.0)
+    arg_parser.add_argument("-t", "--time",
+        help="number of seconds to run",
+        type=float)
+    arg_parser.add_argument("-b", "--baud-rate",
+        help="baud rate for serial port (default: 115200)",
+        type=int, default=115200)
+    arg_parser.add_argument("-r", "--renumber",
+        help="renumber tag IDs starting from 1",
+        action="store_true")
+    arg_parser.add_argument("--report",
+        help="seconds between latency reports on stderr, 0 for none (default: 5)",
+        type=float, default=5.0)
+    args = arg_parser.parse_args()
+    given = dict((axis, getattr(args, axis)) for axis in Model.AXES
+        if getattr(args, axis) is not None)
+    if len(given) == len(Model.AXES):
+        arg_parser.error("at least one axis must be left to locate")
+
+    rssi_filter = make_filters(args.filter)
+    stop = threading.Event()
+    sources = []
+    for receiver, infile in enumerate(args.infiles, 1):
+        tag_id = receiver if args.renumber else None
+        if os.path.dirname(infile) == "/dev" or infile.startswith("COM"):
+            source = PortReader(infile, receiver, float("inf"), stop, args.baud_rate,
+                tag_id=tag_id, keep=False)
+        else:
+            if os.path.isdir(infile):
+                infile += "/raw.csv"
+            source = Replay(infile, receiver, stop, args.speed, tag_id=tag_id)
+        sources.append(source)
+    # Replays, started together, share the first one's clock
+    replays = all(isinstance(source, Replay) for source in sources)
+    localizer = Localizer(Model.cached(args.model, resolution=args.resolution, rssi_filter=rssi_filter),
+        args.window, args.ord, given, rssi_filter, sources[0].clock if replays else None)
+    for source in sources:
+        source.on_packet = localizer.add
+    output = Broadcast(args.port)
+    for source in sources:
+        source.start()
+    try:
+        run(localizer, sources, args.rate, output, args.report, args.time)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        output.close()
@@ -0,0 +1,770 @@
+import hashlib
+import os
+import pickle
+import zipfile
+import numpy as np
+import calibration
+from datapoints import CHANNELS
+from aggregate import group_stats
+from dataset import find_captures, load_dataset
+from filters import filter_rssi
+from parse_cache import PARSER_VERSION, cache_dir, file_hash
+
+# The fingerprint index needs SciPy; everything else works without it
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+def spline_matrix(x, x_new, period=None):
+    ''' Matrix W such that W @ y interpolates a cubic spline through (x, y) at x_new.
+
+    `x` must be sorted. The spline is natural (no curvature at the ends)
+    and x_new outside [x[0], x[-1]] is NaN, unless `period` is given, in
+    which case it wraps around with that period and is smooth throughout.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    x_new = np.asarray(x_new, dtype=np.float64)
+    n = len(x)
+    if n == 1:
+        return np.ones((len(x_new), 1))
+    if period is not None:
+        knots = np.append(x, x[0] + period)
+        x_new = x[0] + (x_new - x[0]) % period
+    else:
+        knots = x
+    h = np.diff(knots)
+
+    # Second derivatives M solve A @ M = B @ y; natural ends have M = 0
+    m = len(h)
+    a = np.zeros((n, n))
+    b = np.zeros((n, n))
+    rows = range(n) if period is not None else range(1, n - 1)
+    for i in rows:
+        before, after = (i - 1) % m, i % m
+        a[i, (i - 1) % n] += h[before]
+        a[i, i] += 2 * (h[before] + h[after])
+        a[i, (i + 1) % n] += h[after]
+        b[i, (i + 1) % n] += 6 / h[after]
+        b[i, i] -= 6 / h[after] + 6 / h[before]
+        b[i, (i - 1) % n] += 6 / h[before]
+    if period is None:
+        a[0, 0] = a[-1, -1] = 1.0
+    second = np.linalg.solve(a, b)
+
+    # On [knots[j], knots[j+1]] the spline mixes y and M at both ends
+    j = np.searchsorted(knots, x_new, side="right").clip(1, m) - 1
+    left, right = knots[j + 1] - x_new, x_new - knots[j]
+    hj = h[j]
+    w = np.zeros((len(x_new), n))
+    rows = np.arange(len(x_new))
+    lo, hi = j % n, (j + 1) % n
+    np.add.at(w, (rows, lo), left / hj)
+    np.add.at(w, (rows, hi), right / hj)
+    w += ((left ** 3 / hj - left * hj) / 6)[:, None] * second[lo]
+    w += ((right ** 3 / hj - right * hj) / 6)[:, None] * second[hi]
+    if period is None:
+        w[(x_new < x[0]) | (x_new > x[-1])] = np.nan
+    return w
+
+
+class Predictions:
+    ''' The k cells nearest to each of N queries, nearest first.
+
+    `cells` holds their indices into the model's fingerprint array and
+    `values` their radius, azimuth and orientation, both of shape (N, k, 3);
+    `distances` has shape (N, k). Queries with fewer than k candidates are
+    padded with index -1, NaN values and infinite distances.
+    '''
+    def __init__(self, cells, values, distances):
+        self.cells = cells
+        self.values = values
+        self.distances = distances
+
+    @property
+    def best(self):
+        ''' The nearest cell's (radius, azimuth, orientation) for each query. '''
+        return self.values[:, 0]
+
+
+class Model:
+    ''' RSSI fingerprints by radius, azimuth and tag orientation.
+
+    Fingerprints (the mean RSSI on each channel) are kept in a dense array
+    of shape (R, A, O, channels), with the number of packets and RSSI
+    variance behind each in `counts` and `variances` (0 and NaN where
+    unknown). `values` holds the sorted radii, azimuths and orientations
+    along each axis and `index` maps each value to its position. Cells
+    that were never captured are NaN and False in `mask`. Marginals are
+    cached until the model changes.
+    '''
+    AXES = ["radius", "azimuth", "orientation"]
+
+    # Azimuth of each tag of the ring, numbered clockwise from 270 degrees
+    TAG_AZIMUTHS = {
+        1: 270.0,
+        2: 225.0,
+        3: 180.0,
+        4: 135.0,
+        5: 90.0,
+        6: 45.0,
+        7: 0.0,
+        8: 315.0,
+    }
+
+    # RSSI is reported in whole dBm, which alone spreads it by 1/12 dBm^2
+    MIN_VAR = 1.0 / 12
+
+    # Bump whenever the saved format changes
+    VERSION = 1
+
+    def __init__(self, channels=CHANNELS):
+        self.channels = list(channels)
+        self.values = [np.empty(0) for _ in self.AXES]
+        self.index = [{} for _ in self.AXES]
+        self.fingerprints = np.empty((0, 0, 0, len(self.channels)))
+        self.counts = np.zeros((0, 0, 0, len(self.channels)), dtype=np.int64)
+        self.variances = np.empty((0, 0, 0, len(self.channels)))
+        self.mask = np.zeros((0, 0, 0), dtype=bool)
+        self.tag_azimuths = dict(self.TAG_AZIMUTHS)
+        self.source = ""
+        self.tree = None
+        self.__marginals = {}
+
+    @classmethod
+    def __get_ids(cls, datapoints):
+        return datapoints.get_ids()
+
+    @classmethod
+    def __abs_azimuth(cls, id):
+        return cls.TAG_AZIMUTHS[id]
+
+    @classmethod
+    def __rel_angle(cls, abs_tag_angle, abs_receiver_angle):
+        return (abs_tag_angle - abs_receiver_angle) % 360.0
+
+    @classmethod
+    def make_vector(cls, datapoints, id):
+        return tuple(float(np.mean(datapoints.select(tag=id, channel=ch).rssi))
+            for ch in CHANNELS)
+
+    def __grow(self, axis, new_values):
+        ''' Add values along an axis, with uncaptured cells for them. '''
+        new_values = np.setdiff1d(np.asarray(new_values, dtype=np.float64), self.values[axis])
+        if not len(new_values):
+            return
+        values = np.union1d(self.values[axis], new_values)
+        positions = np.searchsorted(self.values[axis], new_values)
+        self.fingerprints = np.insert(self.fingerprints, positions, np.nan, axis=axis)
+        self.counts = np.insert(self.counts, positions, 0, axis=axis)
+        self.variances = np.insert(self.variances, positions, np.nan, axis=axis)
+        self.mask = np.insert(self.mask, positions, False, axis=axis)
+        self.values[axis] = values
+        self.index[axis] = dict((value, i) for i, value in enumerate(values.tolist()))
+
+    def add_cells(self, radius, azimuth, orientation, fingerprints, counts=None, variances=None):
+        ''' Set the fingerprints of many cells at once; the arguments are parallel arrays. '''
+        coords = [np.atleast_1d(np.asarray(v, dtype=np.float64)) for v in (radius, azimuth, orientation)]
+        for axis, values in enumerate(coords):
+            self.__grow(axis, values)
+        cells = tuple(np.searchsorted(self.values[axis], values)
+            for axis, values in enumerate(coords))
+        if not self.fingerprints.flags.writeable:
+            # Loaded arrays are memory-mapped read-only
+            for key in ["fingerprints", "counts", "variances", "mask"]:
+                setattr(self, key, np.array(getattr(self, key)))
+        shape = (-1, len(self.channels))
+        self.fingerprints[cells] = np.asarray(fingerprints, dtype=np.float64).reshape(shape)
+        self.counts[cells] = 0 if counts is None else np.asarray(counts).reshape(shape)
+        self.variances[cells] = np.nan if variances is None else \
+            np.asarray(variances, dtype=np.float64).reshape(shape)
+        self.mask[cells] = True
+        self.tree = None
+        self.__marginals.clear()
+
+    def add_data(self, data, radius, receiver_orientation, rssi_filter=None):
+        ''' Add the fingerprint of every tag in a capture from one receiver position.
+
+        `rssi_filter` is a list of filters (see filters.py) to run the
+        RSSI through first.
+        '''
+        ids = self.__get_ids(data)
+        azimuths = [self.__rel_angle(self.tag_azimuths[id], receiver_orientation) for id in ids]
+        stats = group_stats(data, self.channels,
+            filter_rssi(data, rssi_filter) if rssi_filter else None)
+        self.add_cells(np.full(len(ids), radius), azimuths,
+            np.full(len(ids), self.__rel_angle(270, receiver_orientation)),
+            stats.mean, stats.count, stats.var)
+
+    @classmethod
+    def from_captures(cls, root=os.curdir, channels=CHANNELS, rssi_filter=None):
+        ''' Build a model from every "<radius> cm, <receiver orientation> deg" capture under root. '''
+        model = cls(channels)
+        for capture, datapoints in load_dataset(root).items():
+            model.add_data(datapoints, capture.radius, capture.angle, rssi_filter)
+        model.source = cls.source_hash(root)
+        return model
+
+    @classmethod
+    def source_hash(cls, root=os.curdir):
+        ''' Hash of the captures under root, as of the parser and model versions
+        and the RSSI calibration in use. '''
+        h = hashlib.blake2b(digest_size=16)
+        h.update("{} {} {}\n".format(PARSER_VERSION, cls.VERSION, calibration.checksum()).encode("utf-8"))
+        for capture, path in find_captures(root):
+            h.update("{!r} {}\n".format(tuple(capture), file_hash(path)).encode("utf-8"))
+        return h.hexdigest()
+
+    def save(self, path):
+        ''' Write the model to an uncompressed .npz file, which load can memory-map. '''
+        np.savez(path,
+            version=np.array(self.VERSION),
+            source=np.array(self.source),
+            channels=np.array(self.channels),
+            radius=self.values[0],
+            azimuth=self.values[1],
+            orientation=self.values[2],
+            fingerprints=self.fingerprints,
+            counts=self.counts,
+            variances=self.variances,
+            mask=self.mask,
+            tag_ids=np.array(sorted(self.tag_azimuths), dtype=np.int64),
+            tag_azimuths=np.array([self.tag_azimuths[id] for id in sorted(self.tag_azimuths)]))
+
+    @staticmethod
+    def __mmap_npz(path):
+        ''' Memory-map every array of an uncompressed .npz file, by name. '''
+        arrays = {}
+        with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+            for info in archive.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError("{} is compressed".format(path))
+                # The member's data follows its local header, whose
+                # name and extra field lengths are at bytes 26 and 28
+                f.seek(info.header_offset + 26)
+                lengths = np.frombuffer(f.read(4), dtype="<u2")
+                f.seek(info.header_offset + 30 + int(lengths.sum()))
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                    else np.lib.format.read_array_header_2_0
+                shape, fortran, dtype = read_header(f)
+                if dtype.hasobject:
+                    raise ValueError("{} holds objects".format(path))
+                arrays[info.filename[:-len(".npy")]] = np.memmap(f, dtype=dtype, mode="r",
+                    offset=f.tell(), shape=shape, order="F" if fortran else "C") \
+                    if np.prod(shape) else np.empty(shape, dtype=dtype)
+        return arrays
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        ''' Read a model written by save, memory-mapping its arrays unless mmap is False.
+
+        Mapped arrays are read-only; a model that is changed afterwards
+        copies them first.
+        '''
+        if mmap:
+            arrays = cls.__mmap_npz(path)
+        else:
+            with np.load(path) as npz:
+                arrays = dict((key, npz[key]) for key in npz.files)
+        if int(arrays["version"]) != cls.VERSION:
+            raise ValueError("{} is version {}, not {}".format(path, int(arrays["version"]), cls.VERSION))
+        model = cls(arrays["channels"].tolist())
+        model.source = str(arrays["source"])
+        model.values = [np.asarray(arrays[axis]) for axis in cls.AXES]
+        model.index = [dict((value, i) for i, value in enumerate(values.tolist()))
+            for values in model.values]
+        for key in ["fingerprints", "counts", "variances", "mask"]:
+            setattr(model, key, arrays[key])
+        model.tag_azimuths = dict(zip(arrays["tag_ids"].tolist(), arrays["tag_azimuths"].tolist()))
+        return model
+
+    def interpolate(self, radius_step=1.0, angle_step=5.0):
+        ''' Tabulate a smooth field through the fingerprints on a finer grid.
+
+        Returns a new Model with radii every `radius_step` between the
+        smallest and largest captured and angles every `angle_step`
+        degrees. The field is a cubic spline along radius and a periodic
+        one along both angles, fitted one axis at a time through the cells
+        captured along each line. Variances and counts are interpolated
+        alike. Matching against it gives estimates between the captured
+        cells, at the cost of a larger grid; build its KD-tree to keep
+        joint searches fast.
+        '''
+        steps = [radius_step, angle_step, angle_step]
+        values = []
+        for axis, step in enumerate(steps):
+            if axis == 0:
+                lo, hi = self.values[0][0], self.values[0][-1]
+                values.append(lo + step * np.arange(int(np.floor((hi - lo) / step + 1e-9)) + 1))
+            else:
+                values.append(step * np.arange(int(np.ceil(360.0 / step - 1e-9))))
+
+        fields = [np.where(self.mask[..., None], table, np.nan)
+            for table in (self.fingerprints, self.variances, self.counts.astype(np.float64))]
+        for axis in range(len(self.AXES)):
+            period = None if axis == 0 else 360.0
+            fields = [self.__interpolate_axis(field, axis, self.values[axis], values[axis], period)
+                for field in fields]
+        fingerprints, variances, counts = fields
+
+        model = type(self)(self.channels)
+        model.values = values
+        model.index = [dict((value, i) for i, value in enumerate(v.tolist())) for v in values]
+        model.fingerprints = fingerprints
+        model.variances = np.maximum(variances, 0.0)
+        model.counts = np.rint(np.nan_to_num(counts).clip(0)).astype(np.int64)
+        model.mask = ~np.isnan(fingerprints).all(axis=3)
+        model.tag_azimuths = dict(self.tag_azimuths)
+        model.source = self.source
+        return model
+
+    @staticmethod
+    def __interpolate_axis(field, axis, x, x_new, period):
+        ''' Interpolate along one axis, line by line through the values each line has. '''
+        lines = np.moveaxis(field, axis, -1)
+        shape = lines.shape[:-1]
+        lines = lines.reshape(-1, len(x))
+        result = np.full((len(lines), len(x_new)), np.nan)
+        # Lines with the same gaps share one interpolation matrix
+        known = ~np.isnan(lines)
+        patterns, inverse = np.unique(known, axis=0, return_inverse=True)
+        for p, pattern in enumerate(patterns):
+            if not pattern.any():
+                continue
+            rows = inverse.reshape(-1) == p
+            result[rows] = lines[rows][:, pattern] @ spline_matrix(x[pattern], x_new, period).T
+        return np.moveaxis(result.reshape(shape + (len(x_new),)), -1, axis)
+
+    @classmethod
+    def cached(cls, root=os.curdir, channels=CHANNELS, resolution=None, rssi_filter=None):
+        ''' Load the model of the captures under root, rebuilding it only if they changed.
+
+        Models are kept in the parse cache directory, keyed by root, and
+        are rebuilt whenever the captures' hash or the channels differ.
+        Caching is disabled along with the parse cache. Given a resolution
+        of (radius step, angle step), the model's interpolated field is
+        loaded instead, and cached next to it. Models built with an
+        `rssi_filter` are cached apart, by the filters' parameters.
+        '''
+        cache = cache_dir()
+        if not cache:
+            model = cls.from_captures(root, channels, rssi_filter)
+            return model if resolution is None else model.interpolate(*resolution)
+        key = os.path.abspath(root)
+        if resolution is not None:
+            key += " {!r} {!r}".format(*[float(step) for step in resolution])
+        if rssi_filter:
+            key += " {!r}".format(list(rssi_filter))
+        name = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        path = os.path.join(cache, "models", name + ".npz")
+        source = cls.source_hash(root)
+        try:
+            model = cls.load(path)
+            if model.source == source and model.channels == list(channels):
+                return model
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass
+        if resolution is None:
+            model = cls.from_captures(root, channels, rssi_filter)
+        else:
+            model = cls.cached(root, channels, rssi_filter=rssi_filter).interpolate(*resolution)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp.npz".format(path[:-len(".npz")], os.getpid())
+        model.save(tmp)
+        os.replace(tmp, path)
+        return model
+
+    def cell(self, radius, azimuth, rel_orientation):
+        ''' Index of a cell in the fingerprint array. '''
+        return (self.index[0][radius], self.index[1][azimuth], self.index[2][rel_orientation])
+
+    def marginal(self, axis):
+        ''' Mean fingerprint of the captured cells at each value along an axis. '''
+        if axis not in self.__marginals:
+            others = tuple(i for i in range(len(self.AXES)) if i != axis)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                total = np.where(self.mask[..., None], self.fingerprints, 0.0).sum(axis=others)
+                self.__marginals[axis] = total / self.mask.sum(axis=others)[:, None]
+        return self.__marginals[axis]
+
+    def get(self, radius, azimuth, rel_orientation, only_r=False, only_a=False, only_o=False):
+        if only_r:
+            return tuple(self.marginal(0)[self.index[0][radius]].tolist())
+        elif only_a:
+            return tuple(self.marginal(1)[self.index[1][azimuth]].tolist())
+        elif only_o:
+            return tuple(self.marginal(2)[self.index[2][rel_orientation]].tolist())
+        else:
+            return tuple(self.fingerprints[self.cell(radius, azimuth, rel_orientation)].tolist())
+
+    def __indexed_cells(self):
+        ''' Captured cells with a complete fingerprint, in C order. '''
+        complete = self.mask & ~np.isnan(self.fingerprints).any(axis=3)
+        return np.argwhere(complete), self.fingerprints[complete]
+
+    def checksum(self):
+        ''' Hash of the axis values and fingerprints, to tell whether an index is stale. '''
+        h = hashlib.blake2b(digest_size=16)
+        for values in self.values:
+            h.update(np.ascontiguousarray(values).tobytes())
+        h.update(np.ascontiguousarray(self.mask).tobytes())
+        h.update(np.ascontiguousarray(self.fingerprints[self.mask]).tobytes())
+        return h.hexdigest()
+
+    def build_tree(self, leafsize=16):
+        ''' Build a KD-tree over the fingerprints for joint searches; needs SciPy.
+
+        The tree is dropped whenever the model changes.
+        '''
+        if cKDTree is None:
+            raise ImportError("the fingerprint index needs scipy")
+        cells, fingerprints = self.__indexed_cells()
+        self.tree = (cKDTree(fingerprints, leafsize=leafsize), cells)
+        return self.tree
+
+    def save_tree(self, path):
+        ''' Write the KD-tree to a file, with the checksum of the model it indexes. '''
+        with open(path, "wb") as f:
+            pickle.dump({"checksum": self.checksum(), "tree": self.tree}, f)
+
+    def load_tree(self, path):
+        ''' Read a KD-tree written by save_tree, which must index this very model. '''
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        if saved["checksum"] != self.checksum():
+            raise ValueError("{} indexes a different model".format(path))
+        self.tree = saved["tree"]
+        return self.tree
+
+    def query_radius(self, queries, r, ord=2):
+        ''' Cells within distance r of each query, nearest first.
+
+        Returns one (n, 3) array of (radius, azimuth, orientation) per query.
+        Uses the KD-tree if one was built.
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        if self.tree is not None:
+            tree, cells = self.tree
+            neighbours = tree.query_ball_point(queries, r, p=ord)
+            found = []
+            for query, indices in zip(queries, neighbours):
+                indices = np.asarray(indices, dtype=np.intp)
+                d = np.linalg.norm(tree.data[indices] - query, ord=ord, axis=1)
+                found.append(cells[indices[np.lexsort((indices, d))]])
+        else:
+            cells, fingerprints = self.__indexed_cells()
+            found = []
+            for query in queries:
+                d = np.linalg.norm(fingerprints - query, ord=ord, axis=1)
+                indices = np.flatnonzero(d <= r)
+                found.append(cells[indices[np.argsort(d[indices], kind="stable")]])
+        return [np.stack([self.values[axis][c[:, axis]] for axis in range(len(self.AXES))], axis=1)
+            for c in found]
+
+    def __fixed(self, num_queries, free_axes, given):
+        ''' Position of the given value along each fixed axis, for every query. '''
+        free = [self.AXES.index(axis) if isinstance(axis, str) else axis for axis in free_axes]
+        fixed = [axis for axis in range(len(self.AXES)) if axis not in free]
+        missing = [self.AXES[axis] for axis in fixed if self.AXES[axis] not in given]
+        if missing:
+            raise ValueError("no value given for {}".format(", ".join(missing)))
+        fixed_index = []
+        for axis in fixed:
+            values = np.broadcast_to(np.asarray(given[self.AXES[axis]], dtype=np.float64),
+                (num_queries,))
+            positions = np.searchsorted(self.values[axis], values).clip(0, len(self.values[axis]) - 1)
+            if len(self.values[axis]) == 0 or (self.values[axis][positions] != values).any():
+                raise KeyError("{} not in the model".format(self.AXES[axis]))
+            fixed_index.append((axis, positions))
+        return fixed_index
+
+    def predict_batch(self, queries, free_axes=AXES, ord=2, k=1, chunk_size=2**22, partial=False,
+                      **given):
+        ''' Find the captured cells whose fingerprints are nearest to each query.
+
+        `queries` is an (N, channels) array of measured vectors. The search
+        runs jointly over `free_axes`; every other axis must be given as a
+        keyword argument (e.g. radius=50), either one value for all queries
+        or one per query. Distances are vector norms of order `ord`, as in
+        numpy.linalg.norm. Ties go to the cell with the smallest values.
+
+        A cell or query missing a channel (NaN) never matches, unless
+        `partial` is set: then the distance is taken over the channels both
+        have, scaled up to the full number of channels.
+
+        A joint search over every axis uses the KD-tree if one was built;
+        the tree only holds cells with a fingerprint on every channel, so
+        partial searches, which also consider the other cells, never use it.
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        fixed_index = self.__fixed(len(queries), free_axes, given)
+        if self.tree is not None and not fixed_index and not partial:
+            return self.__query_tree(queries, ord, k)
+
+        # Candidates are the captured cells, in C order so ties favour small values
+        cells = np.argwhere(self.mask)
+        fingerprints = self.fingerprints[self.mask]
+        k = min(k, len(cells)) if len(cells) else 0
+        result_cells = np.full((len(queries), k, len(self.AXES)), -1, dtype=np.intp)
+        distances = np.full((len(queries), k), np.inf)
+
+        # Queries given the same values search the same slice of the cells
+        if fixed_index:
+            keys = np.stack([positions for _, positions in fixed_index], axis=1)
+            groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            groups = np.empty((1, 0), dtype=np.intp)
+            inverse = np.zeros(len(queries), dtype=np.intp)
+        order = np.argsort(inverse, kind="stable")
+        members = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(groups)))[:-1])
+        for group, rows in zip(groups, members):
+            in_slice = np.ones(len(cells), dtype=bool)
+            for (axis, _), position in zip(fixed_index, group):
+                in_slice &= cells[:, axis] == position
+            found, found_d = self.__nearest(queries[rows], cells[in_slice],
+                fingerprints[in_slice], ord, k, chunk_size, partial)
+            result_cells[rows, :found.shape[1]] = found
+            distances[rows, :found.shape[1]] = found_d
+
+        return self.__predictions(result_cells, distances)
+
+    @staticmethod
+    def __nearest(queries, cells, fingerprints, ord, k, chunk_size, partial=False):
+        ''' The up to k nearest of the candidate cells to each query, by brute force. '''
+        k = min(k, len(cells))
+        result_cells = np.full((len(queries), k, cells.shape[1]), -1, dtype=np.intp)
+        distances = np.full((len(queries), k), np.inf)
+        step = max(1, chunk_size // max(1, len(cells) * queries.shape[1]))
+        for lo in range(0, len(queries) if k else 0, step):
+            hi = min(lo + step, len(queries))
+            diff = queries[lo:hi, None, :] - fingerprints[None, :, :]
+            if partial:
+                used = ~np.isnan(diff)
+                num_used = used.sum(axis=2)
+                with np.errstate(divide="ignore"):
+                    d = np.linalg.norm(np.where(used, diff, 0.0), ord=ord, axis=2) \
+                        * (diff.shape[2] / num_used) ** (1.0 / ord)
+                d[num_used == 0] = np.inf
+            else:
+                d = np.linalg.norm(diff, ord=ord, axis=2)
+            d[np.isnan(d)] = np.inf
+            if k < len(cells):
+                nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+                # argpartition breaks ties at the kth distance arbitrarily
+                kth = np.take_along_axis(d, nearest, axis=1).max(axis=1, keepdims=True)
+                tied = (d == kth).sum(axis=1) > (np.take_along_axis(d, nearest, axis=1) == kth).sum(axis=1)
+                for row in np.flatnonzero(tied):
+                    nearest[row] = np.argsort(d[row], kind="stable")[:k]
+            else:
+                nearest = np.broadcast_to(np.arange(len(cells)), d.shape)
+            nearest_d = np.take_along_axis(d, nearest, axis=1)
+            order = np.lexsort((nearest, nearest_d), axis=1)
+            nearest = np.take_along_axis(nearest, order, axis=1)
+            distances[lo:hi] = np.take_along_axis(nearest_d, order, axis=1)
+            result_cells[lo:hi] = cells[nearest]
+        return result_cells, distances
+
+    def cell_variances(self, min_var=MIN_VAR):
+        ''' RSSI variance of every cell and channel, at least min_var.
+
+        Where a cell's variance is unknown (fewer than two packets, or
+        added without one) the channel's pooled variance over the other
+        cells stands in.
+        '''
+        known = self.mask[..., None] & np.isfinite(self.variances) & (self.counts > 1)
+        dof = np.where(known, self.counts - 1, 0).sum(axis=(0, 1, 2))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pooled = (np.where(known, self.variances, 0.0) * (self.counts - 1)).sum(axis=(0, 1, 2)) / dof
+        # With nothing to go on, assume 1 dBm of spread
+        pooled = np.where(dof > 0, pooled, 1.0)
+        return np.maximum(np.where(known, self.variances, pooled), min_var)
+
+    def log_likelihood(self, queries, counts=None, min_var=MIN_VAR, chunk_size=2**22):
+        ''' Gaussian log-likelihood of each query at every cell.
+
+        `queries` is an (N, channels) array of mean RSSIs over `counts`
+        packets each (one if not given). Each channel of a cell is taken
+        to be normal with the cell's mean and variance, so a query's mean
+        is off by the spread of both its own and the cell's mean. Channels
+        a query has no packets on (NaN) are left out. Returns an array of
+        shape (N, R, A, O), -inf where a cell was never captured.
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        counts = np.ones(queries.shape) if counts is None else \
+            np.broadcast_to(np.asarray(counts, dtype=np.float64), queries.shape)
+        means = self.fingerprints[self.mask]
+        variances = self.cell_variances(min_var)[self.mask]
+        with np.errstate(divide="ignore"):
+            cell_spread = np.where(self.counts[self.mask] > 0, 1.0 / self.counts[self.mask], 0.0)
+
+        result = np.full((len(queries),) + self.mask.shape, -np.inf)
+        flat = result.reshape(len(queries), -1)
+        captured = np.flatnonzero(self.mask)
+        step = max(1, chunk_size // max(1, means.size))
+        for lo in range(0, len(queries), step):
+            hi = min(lo + step, len(queries))
+            heard = ~np.isnan(queries[lo:hi]) & (counts[lo:hi] > 0)
+            with np.errstate(divide="ignore"):
+                spread = variances[None] * (1.0 / counts[lo:hi, None, :] + cell_spread[None])
+            terms = -0.5 * ((queries[lo:hi, None, :] - means[None]) ** 2 / spread
+                + np.log(2 * np.pi * spread))
+            # A cell missing a channel the query heard cannot explain it
+            terms[np.isnan(terms) & heard[:, None, :]] = -np.inf
+            terms[~np.broadcast_to(heard[:, None, :], terms.shape)] = 0.0
+            flat[lo:hi, captured] = terms.sum(axis=2)
+        return result
+
+    def posterior(self, queries, counts=None, free_axes=AXES, prior=None, min_var=MIN_VAR, **given):
+        ''' Posterior probability of every cell for each query, of shape (N, R, A, O).
+
+        Axes not in `free_axes` are given as keyword arguments, as for
+        predict_batch. `prior` is an optional (R, A, O) array of weights,
+        uniform over the captured cells by default. Queries no cell can
+        explain get NaN.
+        '''
+        log_p = self.log_likelihood(queries, counts, min_var)
+        for axis, positions in self.__fixed(len(log_p), free_axes, given):
+            shape = [1] * log_p.ndim
+            shape[axis + 1] = -1
+            along = np.arange(len(self.values[axis])).reshape(shape)
+            elsewhere = along != positions.reshape((-1,) + (1,) * len(self.AXES))
+            log_p[np.broadcast_to(elsewhere, log_p.shape)] = -np.inf
+        if prior is not None:
+            with np.errstate(divide="ignore"):
+                log_p = log_p + np.log(np.asarray(prior, dtype=np.float64))
+        top = log_p.max(axis=(1, 2, 3), keepdims=True)
+        with np.errstate(invalid="ignore"):
+            p = np.exp(log_p - top)
+            return p / p.sum(axis=(1, 2, 3), keepdims=True)
+
+    def most_likely(self, posterior):
+        ''' The (radius, azimuth, orientation) of each query's most probable cell. '''
+        posterior = np.asarray(posterior)
+        flat = posterior.reshape(len(posterior), -1)
+        values = np.full((len(posterior), len(self.AXES)), np.nan)
+        found = ~np.isnan(flat).any(axis=1)
+        cells = np.unravel_index(flat[found].argmax(axis=1), posterior.shape[1:])
+        for axis in range(len(self.AXES)):
+            values[found, axis] = self.values[axis][cells[axis]]
+        return values
+
+    def __query_tree(self, queries, ord, k):
+        tree, cells = self.tree
+        k = min(k, len(cells))
+        if k == 0:
+            return self.__predictions(np.full((len(queries), 0, len(self.AXES)), -1, dtype=np.intp),
+                np.full((len(queries), 0), np.inf))
+        distances, nearest = tree.query(queries, k=[i + 1 for i in range(k)], p=ord)
+        return self.__predictions(cells[nearest], distances)
+
+    def __predictions(self, result_cells, distances):
+        valid = np.isfinite(distances)
+        result_cells[~valid] = -1
+        values = np.full(result_cells.shape, np.nan)
+        for axis in range(len(self.AXES)):
+            values[..., axis][valid] = self.values[axis][result_cells[..., axis][valid]]
+        return Predictions(result_cells, values, distances)
+
+
+class FusedModel(Model):
+    ''' Fingerprints of the same cells from several receivers, matched jointly.
+
+    Each receiver has its own Model; they are laid onto one grid, the
+    union of theirs, and their fingerprints stacked into vectors of
+    receivers x channels, so that `channels` repeats once per receiver
+    and `receivers` gives each component's receiver. Cells a receiver
+    did not capture are NaN in its components, and every matcher scores
+    a cell over the components it has, scaled up to those the query has,
+    rather than rejecting the cell. Queries are (N, receivers, channels)
+    arrays, or stacked (N, receivers * channels).
+    '''
+    def __init__(self, models):
+        models = list(models)
+        if not models or any(m.channels != models[0].channels for m in models):
+            raise ValueError("receivers' models must have the same channels")
+        num_channels = len(models[0].channels)
+        super().__init__(models[0].channels * len(models))
+        self.num_receivers = len(models)
+        self.receivers = np.repeat(np.arange(len(models)), num_channels)
+        self.values = [np.unique(np.concatenate([m.values[axis] for m in models]))
+            for axis in range(len(self.AXES))]
+        self.index = [dict((value, i) for i, value in enumerate(values.tolist()))
+            for values in self.values]
+        shape = tuple(len(values) for values in self.values)
+        self.fingerprints = np.full(shape + (len(self.channels),), np.nan)
+        self.counts = np.zeros(shape + (len(self.channels),), dtype=np.int64)
+        self.variances = np.full(shape + (len(self.channels),), np.nan)
+        self.mask = np.zeros(shape, dtype=bool)
+        for receiver, m in enumerate(models):
+            cells = np.ix_(*[np.searchsorted(self.values[axis], m.values[axis])
+                for axis in range(len(self.AXES))])
+            components = slice(receiver * num_channels, (receiver + 1) * num_channels)
+            for key, fill in [("fingerprints", np.nan), ("counts", 0), ("variances", np.nan)]:
+                table = getattr(self, key)[cells]
+                table[..., components] = np.where(m.mask[..., None], getattr(m, key), fill)
+                getattr(self, key)[cells] = table
+            self.mask[cells] |= m.mask
+        self.source = " ".join(m.source for m in models)
+
+    def stack(self, queries, mask=None):
+        ''' Flatten (N, receivers, channels) queries, blanking out masked receivers or channels.
+
+        `mask` is True for the receivers to use, for all queries
+        (receivers,) or each (N, receivers), or for the components to use
+        (N, receivers, channels).
+        '''
+        queries = np.array(queries, dtype=np.float64)
+        queries = queries.reshape(-1, self.num_receivers, len(self.channels) // self.num_receivers)
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.ndim < 3:
+                mask = mask[..., None]
+            queries[~np.broadcast_to(mask, queries.shape)] = np.nan
+        return queries.reshape(len(queries), -1)
+
+    def add_data(self, data, radius, receiver_orientation, rssi_filter=None):
+        raise TypeError("add each receiver's captures to its own Model")
+
+    def predict_batch(self, queries, free_axes=Model.AXES, ord=2, k=1, chunk_size=2**22,
+                      mask=None, **given):
+        ''' Match stacked queries as Model.predict_batch does, over the components both have. '''
+        return super().predict_batch(self.stack(queries, mask), free_axes, ord, k, chunk_size,
+            partial=True, **given)
+
+    def log_likelihood(self, queries, counts=None, min_var=Model.MIN_VAR, chunk_size=2**22,
+                       mask=None):
+        ''' Log-likelihood of stacked queries as Model.log_likelihood gives it.
+
+        At a cell missing some of the components a query has, the
+        log-likelihood over the rest is scaled up to all of the query's,
+        as predict_batch scales distances, so that a partial cell is not
+        favoured for having fewer terms. A cell sharing none of them
+        cannot explain the query.
+        '''
+        queries = self.stack(queries, mask)
+        if counts is not None and np.ndim(counts) == 3:
+            counts = np.reshape(counts, (len(counts), -1))
+        heard = ~np.isnan(queries)
+        if counts is not None:
+            heard &= np.broadcast_to(np.asarray(counts), queries.shape) > 0
+        num_heard = heard.sum(axis=1)
+        # Scored one group of components at a time: those each cell has
+        missing = np.isnan(self.fingerprints)
+        patterns, inverse = np.unique(missing[self.mask], axis=0, return_inverse=True)
+        result = np.full((len(queries),) + self.mask.shape, -np.inf)
+        cells = np.argwhere(self.mask)
+        for p, pattern in enumerate(patterns):
+            group = np.zeros(self.mask.shape, dtype=bool)
+            group[tuple(cells[inverse.reshape(-1) == p].T)] = True
+            masked = queries.copy()
+            masked[:, pattern] = np.nan
+            full = super().log_likelihood(masked, counts, min_var, chunk_size)
+            shared = (heard & ~pattern).sum(axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scale = np.where(shared > 0, num_heard / shared, np.where(num_heard > 0, np.inf, 1.0))
+                result[:, group] = np.where(scale[:, None] == np.inf, -np.inf,
+                    full[:, group] * scale[:, None])
+        return result
@@ -0,0 +1,146 @@
+''' Cache of parsed captures.
+
+Parsed DataPoints tables are stored as .npz files in a cache directory,
+named by a hash of the capture's contents and the parser version. For
+every capture path a small stat file records its size, mtime and content
+hash. Unchanged files are then found without reading them. A file whose
+size or mtime changed is re-hashed, and only re-parsed if its contents
+changed too. Entries are evicted least recently used first once the cache
+grows past its size limit.
+
+The cache lives in $MOBIUS_CACHE (default ~/.cache/mobius). Setting it
+to an empty string disables caching. $MOBIUS_CACHE_SIZE sets the limit
+in megabytes (default 512).
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+from datapoints import DataPoints, calibrated, read_csv
+
+
+# Bump whenever parsing changes what a capture turns into
+PARSER_VERSION = 1
+
+
+def cache_dir():
+    return os.environ.get("MOBIUS_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "mobius"))
+
+
+def cache_limit():
+    return int(float(os.environ.get("MOBIUS_CACHE_SIZE", 512)) * 2**20)
+
+
+def content_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def __atomic_write(path, write):
+    ''' Write a file through a temporary one, so readers never see half of it. '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def __stat_path(root, path):
+    name = hashlib.blake2b(os.path.abspath(path).encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(root, "stat", name + ".json")
+
+
+def __entry_path(root, key):
+    return os.path.join(root, "data", "{}-v{}.npz".format(key, PARSER_VERSION))
+
+
+def __lookup_hash(root, path, st):
+    ''' Get the content hash of a capture, reusing it while size and mtime match. '''
+    stat_path = __stat_path(root, path)
+    try:
+        with open(stat_path) as f:
+            known = json.load(f)
+        if known["size"] == st.st_size and known["mtime_ns"] == st.st_mtime_ns:
+            return known["hash"]
+    except (OSError, ValueError, KeyError):
+        pass
+    key = content_hash(path)
+    record = json.dumps({"path": os.path.abspath(path), "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns, "hash": key}).encode("utf-8")
+    __atomic_write(stat_path, lambda f: f.write(record))
+    return key
+
+
+def file_hash(path):
+    ''' Content hash of a file, reusing the one recorded while its size and mtime match. '''
+    root = cache_dir()
+    if not root:
+        return content_hash(path)
+    os.makedirs(os.path.join(root, "stat"), exist_ok=True)
+    return __lookup_hash(root, path, os.stat(path))
+
+
+def evict(root=None, limit=None):
+    ''' Remove least recently used entries until the cache fits its limit. '''
+    root = root if root is not None else cache_dir()
+    limit = limit if limit is not None else cache_limit()
+    data = os.path.join(root, "data")
+    entries = []
+    for entry in os.scandir(data):
+        if entry.name.endswith(".npz"):
+            # Another process may be evicting at the same time
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def load_csv(path, tag_id=None, calibrate=True):
+    ''' Parse a CSV capture, or load it from the cache if it was parsed before.
+
+    The cache keeps the RSSI as received; it is calibrated as read_csv
+    calibrates it once loaded.
+    '''
+    root = cache_dir()
+    if not root:
+        with open(path) as f:
+            return read_csv(f, tag_id=tag_id, calibrate=calibrate)
+    for sub in ["stat", "data"]:
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    entry = __entry_path(root, __lookup_hash(root, path, os.stat(path)))
+    try:
+        with np.load(entry) as npz:
+            datapoints = DataPoints(**dict((key, npz[key]) for key in DataPoints.COLUMNS))
+        # Entries are used least recently used first, by mtime
+        os.utime(entry)
+    except (OSError, ValueError, KeyError):
+        with open(path) as f:
+            datapoints = read_csv(f, calibrate=False)
+        __atomic_write(entry, lambda f: np.savez(f, **dict(
+            (key, getattr(datapoints, key)) for key in DataPoints.COLUMNS)))
+        evict(root)
+
+    if tag_id is not None:
+        datapoints = DataPoints(np.full(len(datapoints), tag_id),
+            *[getattr(datapoints, key) for key in DataPoints.COLUMNS[1:]])
+    return calibrated(datapoints) if calibrate else datapoints
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+''' Locate tags as packets arrive, stopping as soon as the answer is clear.
+
+Packets are taken in time order, from a capture or a live serial port.
+Each tag's per-channel RSSI means are updated with every advertising
+event (the packets a tag sends on each channel with one sequence number)
+and matched against the model. A tag is decided once its best match has
+stayed confident for a dwell time: by posterior probability, or by the
+distance margin between the best and second best cells. The time this
+took, from the first packet of the capture, is its time to decision.
+
+Run over capture directories, it prints each tag's decision, and where
+the capture's geometry is known (see evaluate.py), whether it was right
+and how it compares with matching the whole capture.
+'''
+
+import argparse
+import collections
+import os
+import threading
+import time
+import numpy as np
+import calibration
+from capture import PortReader
+from dataset import parse_path
+from evaluate import label_capture
+from model import Model
+from parse_cache import load_csv
+
+
+Decision = collections.namedtuple("Decision",
+    ["tag", "time", "estimate", "confidence", "events", "decided"])
+Decision.__doc__ = ''' Where a tag was placed (radius, azimuth, orientation) and
+how confidently, `time` seconds and `events` advertising events into
+the capture. `decided` is False if the tag never met the criterion, in
+which case the estimate is from all of its packets. '''
+
+
+class _Tag:
+    __slots__ = ["count", "total", "sequence_num", "events", "held_since",
+        "estimate", "confidence", "decision"]
+
+    def __init__(self, num_channels):
+        self.count = [0] * num_channels
+        self.total = [0] * num_channels
+        self.sequence_num = None
+        self.events = 0
+        self.held_since = None
+        self.estimate = None
+        self.confidence = np.nan
+        self.decision = None
+
+
+class SequentialEstimator:
+    ''' Decides where each tag is as soon as its match is confident.
+
+    `criterion` is "posterior", the probability of the most likely cell
+    (see Model.posterior), or "margin", how much nearer the best cell is
+    than the second best (in dBm, with distances of order `ord`). A tag
+    is decided once it has been at least `threshold` for `dwell` seconds.
+    Axes not in `free_axes` are given as keyword arguments, either one
+    value or a dict of values by tag.
+    '''
+    CRITERIA = ["posterior", "margin"]
+
+    def __init__(self, model, free_axes=Model.AXES, criterion="posterior", threshold=0.9,
+                 dwell=1.0, ord=2, **given):
+        if criterion not in self.CRITERIA:
+            raise ValueError("unknown criterion: {}".format(criterion))
+        self.model = model
+        self.free_axes = list(free_axes)
+        self.criterion = criterion
+        self.threshold = threshold
+        self.dwell = dwell
+        self.ord = ord
+        self.given = given
+        self.slot = dict((ch, i) for i, ch in enumerate(model.channels))
+        self.start = None
+        self.latest = None
+        self.tags = collections.OrderedDict()
+
+    def __given(self, tag_id):
+        return dict((axis, value[tag_id] if isinstance(value, dict) else value)
+            for axis, value in self.given.items())
+
+    def __update(self, tag_id, state, now):
+        ''' Match a tag after one more advertising event. '''
+        state.events += 1
+        count = np.array(state.count, dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(count > 0, np.array(state.total) / count, np.nan)
+        if self.criterion == "posterior":
+            posterior = self.model.posterior(means[None], count[None], self.free_axes,
+                **self.__given(tag_id))
+            state.estimate = self.model.most_likely(posterior)[0]
+            state.confidence = float(np.nanmax(posterior)) if not np.isnan(posterior).all() else np.nan
+        else:
+            predictions = self.model.predict_batch(means[None], self.free_axes, self.ord, k=2,
+                partial=True, **self.__given(tag_id))
+            state.estimate = predictions.best[0]
+            distances = predictions.distances[0]
+            state.confidence = float(distances[1] - distances[0]) if len(distances) > 1 else np.inf
+
+        if state.confidence >= self.threshold:
+            if state.held_since is None:
+                state.held_since = now
+            if now - state.held_since >= self.dwell:
+                state.decision = Decision(tag_id, now - self.start, tuple(state.estimate.tolist()),
+                    state.confidence, state.events, True)
+        else:
+            state.held_since = None
+
+    def add(self, timestamp, tag_id, sequence_num, rssi, channel):
+        ''' Take one packet; `timestamp` is in milliseconds. '''
+        now = timestamp / 1000.0
+        if self.start is None:
+            self.start = now
+        self.latest = now
+        state = self.tags.get(tag_id)
+        if state is None:
+            state = self.tags[tag_id] = _Tag(len(self.model.channels))
+        if state.decision is not None:
+            return
+        # A new sequence number ends the tag's previous advertising event
+        if state.sequence_num is not None and sequence_num != state.sequence_num:
+            self.__update(tag_id, state, now)
+            if state.decision is not None:
+                return
+        state.sequence_num = sequence_num
+        slot = self.slot.get(channel)
+        if slot is not None:
+            state.count[slot] += 1
+            state.total[slot] += rssi
+
+    @property
+    def done(self):
+        ''' Whether every tag heard so far has been decided. '''
+        return bool(self.tags) and all(state.decision is not None for state in self.tags.values())
+
+    def decisions(self):
+        ''' Every tag's decision, or its estimate so far if it has none. '''
+        decisions = []
+        for tag_id, state in self.tags.items():
+            if state.decision is None and state.sequence_num is not None:
+                # Take in the last event, which no later packet has ended
+                self.__update(tag_id, state, self.latest)
+                state.sequence_num = None
+            decisions.append(state.decision or Decision(tag_id, None,
+                None if state.estimate is None else tuple(state.estimate.tolist()),
+                state.confidence, state.events, False))
+        return decisions
+
+
+def replay(estimator, datapoints):
+    ''' Feed a capture to an estimator packet by packet, stopping once it is done. '''
+    order = np.argsort(datapoints.timestamp, kind="stable")
+    for packet in zip(datapoints.timestamp[order].tolist(), datapoints.tag_id[order].tolist(),
+            datapoints.sequence_num[order].tolist(), datapoints.rssi[order].tolist(),
+            datapoints.channel[order].tolist()):
+        estimator.add(*packet)
+        if estimator.done:
+            break
+    return estimator.decisions()
+
+
+def __format(values):
+    return "{:g} cm, {:g} deg, {:g} deg".format(*values)
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    arg_parser = argparse.ArgumentParser(
+        description="locate tags from as few packets as it takes")
+    arg_parser.add_argument("infiles",
+        help="capture directories or CSV files, or a serial port",
+        nargs="+")
+    arg_parser.add_argument("-m", "--model",
+        help="directory of the model's captures (default: Orientation/Model)",
+        default=os.path.join(here, "Orientation", "Model"))
+    arg_parser.add_argument("-c", "--criterion",
+        help="what must stay above the threshold (default: posterior)",
+        choices=SequentialEstimator.CRITERIA, default="posterior")
+    arg_parser.add_argument("-p", "--threshold",
+        help="posterior probability, or distance margin in dBm (default: 0.9)",
+        type=float, default=0.9)
+    arg_parser.add_argument("-d", "--dwell",
+        help="seconds the criterion must hold (default: 1)",
+        type=float, default=1.0)
+    arg_parser.add_argument("--fix",
+        help="axes to give the true values of, from the captures' geometry",
+        nargs="+", choices=Model.AXES, default=[])
+    arg_parser.add_argument("--ord",
+        help="order of the distance norm for --criterion margin (default: 2)",
+        type=int, default=2)
+    arg_parser.add_argument("-t", "--time",
+        help="number of seconds to read a serial port for",
+        type=float)
+    arg_parser.add_argument("-b", "--baud-rate",
+        help="baud rate for serial port (default: 115200)",
+        type=int, default=115200)
+    args = arg_parser.parse_args()
+    if len(args.fix) == len(Model.AXES):
+        arg_parser.error("at least one axis must be left to locate")
+
+    model = Model.cached(args.model)
+    free_axes = [axis for axis in Model.AXES if axis not in args.fix]
+    times, correct, agree = [], [], []
+    for infile in args.infiles:
+        if os.path.dirname(infile) == "/dev" or infile.startswith("COM"):
+            if args.fix:
+                arg_parser.error("--fix needs captures of known geometry")
+            estimator = SequentialEstimator(model, free_axes, args.criterion,
+                args.threshold, args.dwell, args.ord)
+            lock = threading.Lock()
+            stop = threading.Event()
+            offsets = calibration.active()
+
+            def on_packet(receiver, host_time, *packet):
+                rssi = packet[3] + offsets.offset(packet[0], packet[4]) if offsets else packet[3]
+                with lock:
+                    estimator.add(packet[2], packet[0], packet[1], rssi, packet[4])
+                    if estimator.done:
+                        stop.set()
+            deadline = float("inf") if args.time is None else time.time() + args.time
+            reader = PortReader(infile, 1, deadline, stop, args.baud_rate,
+                on_packet=on_packet, keep=False)
+            reader.start()
+            try:
+                reader.join()
+            except KeyboardInterrupt:
+                stop.set()
+                reader.join()
+            if reader.error:
+                raise reader.error
+            truth = {}
+            with lock:
+                decisions = estimator.decisions()
+            full = {}
+        else:
+            path = os.path.join(infile, "raw.csv") if os.path.isdir(infile) else infile
+            datapoints = load_csv(path)
+            capture = parse_path(os.path.abspath(os.path.dirname(path)))
+            labels = dict((tag, label_capture(capture, tag)) for tag in datapoints.get_ids())
+            truth = dict((tag, label[1:]) for tag, label in labels.items() if label is not None)
+            if args.fix and len(truth) < len(labels):
+                arg_parser.error("--fix needs captures of known geometry: {}".format(infile))
+            given = dict((axis, dict((tag, values[Model.AXES.index(axis)])
+                for tag, values in truth.items())) for axis in args.fix)
+            decisions = replay(SequentialEstimator(model, free_axes, args.criterion,
+                args.threshold, args.dwell, args.ord, **given), datapoints)
+            # What the whole capture would have said, criterion aside
+            full = dict((d.tag, d.estimate) for d in replay(SequentialEstimator(model, free_axes,
+                args.criterion, np.inf, args.dwell, args.ord, **given), datapoints))
+
+        print("{}:".format(infile))
+        for d in decisions:
+            if d.estimate is None:
+                print("  Tag {}: no estimate".format(d.tag))
+                continue
+            line = "  Tag {}: {} after {} events, {}, confidence {:.3}".format(d.tag,
+                "{:.2f} s".format(d.time) if d.decided else "undecided",
+                d.events, __format(d.estimate), d.confidence)
+            if d.tag in truth:
+                right = all(np.isclose(d.estimate[i], truth[d.tag][i]) for i in range(3)
+                    if Model.AXES[i] in free_axes)
+                line += ", true {} ({})".format(__format(truth[d.tag]), "right" if right else "wrong")
+                if d.decided:
+                    correct.append(right)
+            if d.decided:
+                times.append(d.time)
+                if d.tag in full:
+                    agree.append(full[d.tag] == d.estimate)
+            print(line)
+
+    if times:
+        print("Decided {} tags, time to decision: median {:.2f} s, mean {:.2f} s, max {:.2f} s".format(
+            len(times), float(np.median(times)), float(np.mean(times)), float(np.max(times))))
+    if correct:
+        print("Right: {:.4}% of decided tags".format(100 * float(np.mean(correct))))
+    if agree:
+        print("Same as the whole capture: {:.4}% of decided tags".format(100 * float(np.mean(agree))))
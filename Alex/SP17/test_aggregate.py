@@ -0,0 +1,17 @@
+import math
+from aggregate import StreamingStats
+
+
+def test_window_of_repeats_only():
+    # Tag 1's second and third packets repeat its first event, on the other
+    # channels, in a window of their own
+    stats = StreamingStats(window=1000, bucket=1000, repeats="event")
+    stats.add(1, 7, 0, -60, 37)
+    stats.add(1, 7, 5000, -61, 38)
+    stats.add(1, 7, 5010, -62, 39)
+    summary = stats.summary(window=True)
+    assert summary["num_expected"] == {1: 0}
+    assert summary["num_received"] == {1: 0}
+    assert math.isnan(summary["loss_rate"][1])
+    assert summary["rssi_avg"] == {1: -61.5}
+    assert stats.summary()["loss_rate"] == {1: 0.0}